@@ -0,0 +1,81 @@
+import asyncio
+import random
+import time
+import argparse
+from aiohttp import web
+
+# ==========================================
+# 🤖 ЗАГЛУШКА BOT API ДЛЯ НАГРУЗОЧНЫХ ПРОГОНОВ
+# ==========================================
+# Отвечает на методы, которые вызывает main.py, с искусственной задержкой и долей 429.
+# Членство в группах детерминированное: (chat_id + user_id) % 10 == 0 -> member.
+
+def chat_user(chat_id):
+    return {"id": int(chat_id), "is_bot": False, "first_name": f"User{chat_id}"}
+
+class FakeBotAPI:
+    def __init__(self, latency_ms=50, jitter_ms=20, rate_429=0.0, retry_after=1):
+        self.latency_ms, self.jitter_ms, self.rate_429, self.retry_after = latency_ms, jitter_ms, rate_429, retry_after
+        self.calls = {}
+        self.throttled = 0
+        self.sent_messages = 0
+
+    async def _params(self, request):
+        if request.content_type == 'application/json': return await request.json()
+        return {k: v for k, v in (await request.post()).items()}
+
+    def _result(self, method, p):
+        if method == 'getMe': return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == 'getChat':
+            return {"id": int(p['chat_id']), "type": "private", "username": f"user{p['chat_id']}", "first_name": "User", "accent_color_id": 0, "max_reaction_count": 11,
+                    "accepted_gift_types": {"unlimited_gifts": True, "limited_gifts": True, "unique_gifts": True, "premium_subscription": True, "gifts_from_channels": True}}
+        if method == 'getChatMember':
+            status = "member" if (int(p['chat_id']) + int(p['user_id'])) % 10 == 0 else "left"
+            return {"status": status, "user": chat_user(p['user_id'])}
+        if method == 'sendMessage':
+            self.sent_messages += 1
+            return {"message_id": self.sent_messages, "date": int(time.time()), "chat": {"id": int(p['chat_id']), "type": "private"}, "text": p.get('text', '')}
+        if method == 'createInvoiceLink': return f"https://t.me/$bench_{p.get('payload')}_{random.randrange(10**9)}"
+        if method in ('setWebhook', 'deleteWebhook', 'answerPreCheckoutQuery'): return True
+        if method == 'getUpdates': return []
+        return None
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        p = await self._params(request)
+        if method == 'getUpdates':
+            await asyncio.sleep(min(float(p.get('timeout') or 0), 1.0))
+            return web.json_response({"ok": True, "result": []})
+        await asyncio.sleep(max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+        if self.rate_429 and random.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}", "parameters": {"retry_after": self.retry_after}}, status=429)
+        result = self._result(method, p)
+        if result is None: return web.json_response({"ok": False, "error_code": 404, "description": "Not Found: method not found"}, status=404)
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request):
+        return web.json_response({"calls": self.calls, "throttled": self.throttled, "sent_messages": self.sent_messages})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+async def start_fake_bot_api(host, port, **kwargs):
+    api = FakeBotAPI(**kwargs)
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return api, runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(FakeBotAPI(args.latency_ms, args.jitter_ms, args.rate_429).app(), port=args.port)
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import hmac
+import hashlib
+import time
+import random
+import signal
+import asyncio
+import argparse
+import subprocess
+import aiohttp
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bot_api import start_fake_bot_api
+from seed import seed
+
+# ==========================================
+# 📈 НАГРУЗОЧНЫЙ ПРОГОН
+# ==========================================
+# Поднимает заглушку Bot API, запускает main.py против неё и локального Postgres (BOT_MODE=webhook),
+# наполняет базу и гоняет сценарии по эндпоинтам. Печатает p50/p90/p99 и RPS, по желанию сравнивает с прошлым прогоном:
+#   python bench/run.py --database-url postgresql://postgres@localhost/giftflow_bench --reset --json bench.json
+#   python bench/run.py --database-url ... --reset --baseline bench.json --max-regression 0.2
+# ⚠️ --reset очищает таблицы приложения: только для отдельной тестовой базы!
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = "123456:BENCH-TOKEN"
+BENCH_WEBHOOK_SECRET = "bench-secret"
+BENCH_METRICS_TOKEN = "bench-metrics"
+STATS_HEADERS = {"Authorization": f"Bearer {BENCH_METRICS_TOKEN}"}
+WEBHOOK_PATH = "/telegram/webhook"
+
+def sign_init_data(token, user_id):
+    # initData, как его подписывает Telegram: HMAC-SHA256 по отсортированным полям с ключом от токена бота
+    fields = {"auth_date": str(int(time.time())), "query_id": f"bench{user_id}", "user": json.dumps({"id": user_id, "first_name": "Bench"}, separators=(',', ':'))}
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, "\n".join(f"{k}={v}" for k, v in sorted(fields.items())).encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+def percentile(sorted_values, p):
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))]
+
+class Scenario:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.started = self.finished = 0.0
+
+    def report(self):
+        lat = sorted(self.latencies)
+        elapsed = max(self.finished - self.started, 1e-9)
+        return {"n": len(lat), "errors": self.errors, "p50_ms": round(percentile(lat, 50) * 1000, 2), "p90_ms": round(percentile(lat, 90) * 1000, 2),
+                "p99_ms": round(percentile(lat, 99) * 1000, 2), "max_ms": round((lat[-1] if lat else 0) * 1000, 2), "rps": round(len(lat) / elapsed, 1)}
+
+async def run_scenario(session, base_url, name, requests, concurrency):
+    # requests: [(method, path, json_body, headers)]
+    sc = Scenario(name)
+    sem = asyncio.Semaphore(concurrency)
+    async def one(method, path, body, headers):
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, json=body, headers=headers or {}) as resp:
+                    await resp.read()
+                    if resp.status >= 400: sc.errors += 1
+            except Exception: sc.errors += 1
+            sc.latencies.append(time.perf_counter() - t0)
+    sc.started = time.perf_counter()
+    await asyncio.gather(*(one(*r) for r in requests))
+    sc.finished = time.perf_counter()
+    return sc
+
+async def run_santa_draws(session, base_url, games, concurrency, poll_interval, timeout=60):
+    # /api/santa/start только ставит задание: меряем путь от постановки до коммита розыгрыша, опрашивая /api/santa/job
+    sc = Scenario("santa draw (committed)")
+    sem = asyncio.Semaphore(concurrency)
+    async def one(g):
+        async with sem:
+            headers = {"X-Telegram-Init-Data": sign_init_data(BENCH_TOKEN, g['creator_id'])}
+            t0 = time.perf_counter()
+            try:
+                async with session.post(base_url + '/api/santa/start', json={"chat_id": g['creator_id'], "game_id": g['game_id']}, headers=headers) as resp:
+                    job_id = (await resp.json()).get('job_id')
+                state = 'queued' if job_id else None
+                while state in ('queued', 'drawing') and time.perf_counter() - t0 < timeout:
+                    await asyncio.sleep(poll_interval)
+                    async with session.post(base_url + '/api/santa/job', json={"chat_id": g['creator_id'], "job_id": job_id}, headers=headers) as resp:
+                        if resp.status == 429: continue  # лимит на пользователя: просто опрашиваем дальше
+                        state = ((await resp.json()).get('job') or {}).get('state')
+            except Exception: state = None
+            if state in ('notifying', 'done'): sc.latencies.append(time.perf_counter() - t0)
+            else: sc.errors += 1
+    sc.started = time.perf_counter()
+    await asyncio.gather(*(one(g) for g in games))
+    sc.finished = time.perf_counter()
+    return sc
+
+def payment_update(update_id, user_id, collection_id, amount, charge_id):
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "successful_payment": {"currency": "XTR", "total_amount": amount, "invoice_payload": f"collection_{collection_id}", "telegram_payment_charge_id": charge_id, "provider_payment_charge_id": charge_id}}}
+
+async def wait_ready(session, base_url, app_proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if app_proc.poll() is not None: raise RuntimeError(f"main.py exited with code {app_proc.returncode}")
+        try:
+            async with session.get(base_url + "/api/stats", headers=STATS_HEADERS) as resp:
+                if resp.status == 200: return
+        except aiohttp.ClientError: pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("main.py did not become ready")
+
+async def wait_ingested(database_url, charge_prefix, expected, timeout=120):
+    import asyncpg
+    conn = await asyncpg.connect(database_url)
+    try:
+        t0 = time.perf_counter(); deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            done = await conn.fetchval("SELECT COUNT(*) FROM public.contributions WHERE telegram_payment_charge_id LIKE $1", charge_prefix + '%')
+            if done >= expected: return done, time.perf_counter() - t0
+            await asyncio.sleep(0.2)
+        return done, time.perf_counter() - t0
+    finally: await conn.close()
+
+def build_scenarios(data, args, rng):
+    n = args.requests
+    init_data = {}
+    def post(path, body):
+        uid = body['chat_id']
+        if uid not in init_data: init_data[uid] = sign_init_data(BENCH_TOKEN, uid)
+        return ('POST', path, body, {"X-Telegram-Init-Data": init_data[uid]})
+    collections = data['collection_ids']
+    active_members = [u for g in data['santa_active'] for u in g['members']]
+    scenarios = [
+        ("GET /", [('GET', '/', None, {"Accept-Encoding": "gzip, br"}) for _ in range(n)]),
+        ("/api/chats (indexed)", [post('/api/chats', {"chat_id": rng.choice(data['indexed_user_ids'])}) for _ in range(n)]),
+        ("/api/chats (cold)", [post('/api/chats', {"chat_id": u}) for u in data['cold_user_ids'][:max(1, n // 10)]]),
+        ("/api/collections/my", [post('/api/collections/my', {"chat_id": rng.choice(data['user_ids'])}) for _ in range(n)]),
+        ("/api/collections/info", [post('/api/collections/info', {"chat_id": rng.choice(data['user_ids']), "collection_id": rng.choice(collections)}) for _ in range(n)]),
+        ("/api/collections/invoice", [post('/api/collections/invoice', {"chat_id": rng.choice(data['user_ids']), "collection_id": rng.choice(collections[:50]), "amount": rng.choice((10, 50, 100))}) for _ in range(n)]),
+        ("/api/santa/state", [post('/api/santa/state', {"chat_id": rng.choice(active_members)}) for _ in range(n)]),
+    ]
+    return scenarios
+
+async def main(args):
+    rng = random.Random(args.seed)
+    fake_api, fake_runner = await start_fake_bot_api('127.0.0.1', args.fake_api_port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429)
+    base_url = f"http://127.0.0.1:{args.port}"
+    env = {**os.environ, "BOT_TOKEN": BENCH_TOKEN, "DATABASE_URL": args.database_url, "PORT": str(args.port),
+           "TELEGRAM_API_BASE": f"http://127.0.0.1:{args.fake_api_port}", "BOT_MODE": "webhook", "WEBHOOK_BASE_URL": base_url,
+           "WEBHOOK_PATH": WEBHOOK_PATH, "WEBHOOK_SECRET": BENCH_WEBHOOK_SECRET, "METRICS_TOKEN": BENCH_METRICS_TOKEN, "DB_SERVER_SETTINGS": args.db_server_settings}
+    log = open(args.app_log, 'w') if args.app_log else subprocess.DEVNULL
+    app_proc = subprocess.Popen([sys.executable, os.path.join(PROJECT_ROOT, 'main.py')], env=env, stdout=log, stderr=subprocess.STDOUT, cwd=PROJECT_ROOT)
+    results = {}
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency * 2)) as session:
+            await wait_ready(session, base_url, app_proc)
+            print("🌱 Seeding...", flush=True)
+            t0 = time.perf_counter()
+            data = await seed(args.database_url, users=args.users, groups=args.groups, collections=args.collections, contributions=args.contributions,
+                              santa_games=args.santa_games, santa_size=args.santa_size, reset=args.reset, rng_seed=args.seed)
+            print(f"   done in {time.perf_counter() - t0:.1f}s", flush=True)
+
+            for name, requests in build_scenarios(data, args, rng):
+                sc = await run_scenario(session, base_url, name, requests, args.concurrency)
+                results[name] = sc.report()
+                print(f"  {name:<28} {json.dumps(results[name])}", flush=True)
+            sc = await run_santa_draws(session, base_url, data['santa_recruiting'], args.concurrency, args.job_poll_ms / 1000)
+            results[sc.name] = sc.report()
+            print(f"  {sc.name:<28} {json.dumps(results[sc.name])}", flush=True)
+
+            # Платежи: вебхук отвечает, когда платёж лёг в pending_payments; отдельно меряем, как быстро вклады доезжают до contributions
+            prefix = f"bench-pay-{int(time.time())}-"
+            hot = data['collection_ids'][:args.hot_collections]
+            updates = [payment_update(10**9 + i, rng.choice(data['user_ids']), rng.choice(hot), rng.randrange(1, 100), f"{prefix}{i}") for i in range(args.payments)]
+            headers = {"X-Telegram-Bot-Api-Secret-Token": BENCH_WEBHOOK_SECRET}
+            t0 = time.perf_counter()
+            sc = await run_scenario(session, base_url, "webhook payments", [('POST', WEBHOOK_PATH, u, headers) for u in updates], args.concurrency)
+            results[sc.name] = sc.report()
+            done, elapsed = await wait_ingested(args.database_url, prefix, len(updates))
+            elapsed = max(elapsed + sc.finished - sc.started, 1e-9)
+            results["payment ingestion"] = {"n": done, "errors": len(updates) - done, "rps": round(done / elapsed, 1)}
+            print(f"  {'webhook payments':<28} {json.dumps(results[sc.name])}")
+            print(f"  {'payment ingestion':<28} {json.dumps(results['payment ingestion'])}")
+
+            async with session.get(base_url + "/api/stats", headers=STATS_HEADERS) as resp: app_stats = await resp.json()
+        print(f"\n🤖 Fake Bot API: calls={fake_api.calls} throttled={fake_api.throttled}")
+        print(f"🗄️ DB pool: {json.dumps({k: v for k, v in app_stats.get('db', {}).items() if k != 'queries'})}")
+    finally:
+        app_proc.send_signal(signal.SIGINT)
+        try: app_proc.wait(timeout=15)
+        except subprocess.TimeoutExpired: app_proc.kill()
+        await fake_runner.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        regressions = [(name, baseline[name]['p99_ms'], r['p99_ms']) for name, r in results.items() if 'p99_ms' in r and name in baseline and baseline[name].get('p99_ms') and r['p99_ms'] > baseline[name]['p99_ms'] * (1 + args.max_regression)]
+        for name, was, now in regressions: print(f"❌ {name}: p99 {was} ms -> {now} ms")
+        if regressions: return 1
+        print("✅ No p99 regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон GiftFlow против заглушки Bot API и локального Postgres")
+    parser.add_argument('--database-url', default=os.getenv("BENCH_DATABASE_URL"), required=not os.getenv("BENCH_DATABASE_URL"))
+    parser.add_argument('--db-server-settings', default=os.getenv("BENCH_DB_SERVER_SETTINGS", "{}"), help="JSON для DB_SERVER_SETTINGS ({} для обычного Postgres)")
+    parser.add_argument('--reset', action='store_true', help="очистить таблицы перед наполнением (только тестовая база!)")
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--fake-api-port', type=int, default=18081)
+    parser.add_argument('--app-log', default=None, help="куда писать вывод main.py")
+    parser.add_argument('--requests', type=int, default=500, help="запросов на сценарий")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=50, help="задержка заглушки Bot API")
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--rate-429', type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--groups', type=int, default=300)
+    parser.add_argument('--collections', type=int, default=5000)
+    parser.add_argument('--contributions', type=int, default=50000)
+    parser.add_argument('--santa-games', type=int, default=200)
+    parser.add_argument('--santa-size', type=int, default=20)
+    parser.add_argument('--job-poll-ms', type=float, default=100, help="как часто опрашивать /api/santa/job")
+    parser.add_argument('--payments', type=int, default=2000)
+    parser.add_argument('--hot-collections', type=int, default=5, help="по скольким сборам размазать платежи")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', default=None, help="сохранить результаты в JSON")
+    parser.add_argument('--baseline', default=None, help="JSON прошлого прогона для сравнения p99")
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    sys.exit(asyncio.run(main(parser.parse_args())))
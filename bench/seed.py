@@ -0,0 +1,50 @@
+import random
+import asyncpg
+
+# ==========================================
+# 🌱 НАПОЛНЕНИЕ БАЗЫ ДЛЯ НАГРУЗОЧНЫХ ПРОГОНОВ
+# ==========================================
+# Таблицы создаёт само приложение при старте (INIT_SQL), сюда приходим уже после него.
+# Все сгенерированные строки помечены префиксом bench, reset=True чистит прошлый прогон.
+USER_BASE = 7_000_000_000
+GROUP_BASE = -1_000_000_000_000
+BENCH_TABLES = ('contributions', 'pending_payments', 'collections', 'santa_participants', 'santa_participants_archive', 'santa_games', 'santa_jobs', 'chat_members', 'known_group_chats', 'notification_outbox')
+
+def is_member(chat_id, user_id):
+    # То же правило, что у bench/fake_bot_api.py
+    return (chat_id + user_id) % 10 == 0
+
+async def reset_bench_data(conn):
+    await conn.execute(f"TRUNCATE {', '.join('public.' + t for t in BENCH_TABLES)} CASCADE")
+
+async def seed(dsn, users=2000, groups=300, collections=5000, contributions=50000, santa_games=200, santa_size=20, indexed_share=0.5, reset=False, rng_seed=42):
+    rng = random.Random(rng_seed)
+    user_ids = [USER_BASE + i for i in range(users)]
+    group_ids = [GROUP_BASE - i for i in range(groups)]
+    indexed = user_ids[:int(users * indexed_share)]
+    conn = await asyncpg.connect(dsn)
+    try:
+        if reset: await reset_bench_data(conn)
+        await conn.copy_records_to_table('known_group_chats', records=[(g, f"bench group {g}") for g in group_ids], columns=['chat_id', 'title'])
+        await conn.execute("UPDATE public.known_group_chats SET last_active = NOW() WHERE title LIKE 'bench group %'")
+        # Проиндексированные пользователи: свежие записи по всем группам (и member, и left)
+        await conn.copy_records_to_table('chat_members', records=[(g, u, 'member' if is_member(g, u) else 'left') for u in indexed for g in group_ids], columns=['chat_id', 'user_id', 'status'])
+        await conn.execute("UPDATE public.chat_members SET updated_at = NOW() WHERE updated_at IS NULL")
+
+        await conn.copy_records_to_table('collections', records=[(rng.choice(user_ids), rng.choice(group_ids), f"bench goal {i}", "bench", "", rng.randrange(1000, 100000), 0, 'active') for i in range(collections)], columns=['creator_id', 'target_chat_id', 'goal', 'description', 'image_url', 'amount', 'current_amount', 'status'])
+        collection_ids = [r['id'] for r in await conn.fetch("SELECT id FROM public.collections WHERE description = 'bench' ORDER BY id")]
+        await conn.copy_records_to_table('contributions', records=[(rng.choice(collection_ids), rng.choice(user_ids), rng.randrange(1, 500), 'XTR', f"bench-seed-{rng_seed}-{i}") for i in range(contributions)], columns=['collection_id', 'user_id', 'amount', 'currency', 'telegram_payment_charge_id'])
+        await conn.execute("""UPDATE public.collections c SET current_amount = s.total FROM (SELECT collection_id, SUM(amount) AS total FROM public.contributions GROUP BY collection_id) s WHERE c.id = s.collection_id AND c.description = 'bench'""")
+
+        # Половина игр в наборе (под /api/santa/start), половина уже разыграна (под /api/santa/state)
+        recruiting, active = [], []
+        for i in range(santa_games):
+            members = rng.sample(user_ids, santa_size)
+            game_id = await conn.fetchval("INSERT INTO public.santa_games (creator_id, title, status) VALUES ($1, $2, $3) RETURNING id", members[0], f"bench santa {i}", 'recruiting' if i % 2 == 0 else 'active')
+            targets = members[1:] + members[:1] if i % 2 else [None] * santa_size
+            await conn.copy_records_to_table('santa_participants', records=[(game_id, u, f"bench wish {u}", t) for u, t in zip(members, targets)], columns=['game_id', 'user_id', 'wishlist', 'target_user_id'])
+            (active if i % 2 else recruiting).append({"game_id": game_id, "creator_id": members[0], "members": members})
+        await conn.execute("ANALYZE")
+    finally:
+        await conn.close()
+    return {"user_ids": user_ids, "indexed_user_ids": indexed, "cold_user_ids": user_ids[len(indexed):], "group_ids": group_ids, "collection_ids": collection_ids, "santa_recruiting": recruiting, "santa_active": active}
@@ -8,28 +8,69 @@ import uuid
 import random
 import traceback
 import re
+import io
+import time
+import hashlib
+import hmac
+import math
+import contextvars
+import gzip
+import mimetypes
+from collections import OrderedDict
 from urllib.parse import quote, urlparse
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from functools import wraps
+from contextlib import asynccontextmanager
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, PreCheckoutQuery
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.utils.web_app import safe_parse_webapp_init_data
 from aiohttp import web
 import asyncpg
 import aiohttp
 
+try: from PIL import Image  # есть в requirements.txt; без Pillow (локальный запуск) картинки уходят в imgbb как есть
+except ImportError: Image = None
+try: import brotli  # есть в requirements.txt; без него (локальный запуск) статика отдаётся только в gzip
+except ImportError: brotli = None
+
 # ==========================================
 # ⚙️ НАСТРОЙКИ
 # ==========================================
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Свой Bot API сервер (или заглушка из bench/fake_bot_api.py для нагрузочных прогонов)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE")
 
 # 🔥 ГЛАВНОЕ ДЛЯ RENDER: Порт берется из системы
 WEB_SERVER_PORT = int(os.getenv("PORT", 8080))
 
+# Режим получения апдейтов: polling (локально, один экземпляр) или webhook (несколько реплик за балансировщиком)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip('/')
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Секрет одинаковый на всех репликах: по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+# Повторы вебхука гасим LRU на реплику: сколько последних update_id помнить
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", 10000))
+
+# Пул соединений: размеры и таймауты из окружения, server_settings — JSON (по умолчанию под CockroachDB)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 200))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+DB_SERVER_SETTINGS = json.loads(os.getenv("DB_SERVER_SETTINGS", '{"multiple_active_portals_enabled": "true"}'))
+
 # Исправление ссылки (asyncpg не любит postgresql://, но Render дает именно её)
 # Мы оставляем как есть, asyncpg умный, но если будут проблемы - раскомментируй строку ниже
 CPA_CONFIG = {
@@ -38,6 +79,108 @@ CPA_CONFIG = {
 }
 URL_REGEX = r'(https?://[^\s]+)'
 
+# Индекс участников групп: сколько верим записи "состоит" и записи "не состоит", сколько живых проверок шлём параллельно
+# и сколько групп без свежей записи проверяем живьём за один запрос (0 — только индекс: сообщения и chat_member)
+MEMBERSHIP_TTL = timedelta(hours=int(os.getenv("MEMBERSHIP_TTL_HOURS", 24)))
+MEMBERSHIP_NEGATIVE_TTL = timedelta(days=int(os.getenv("MEMBERSHIP_NEGATIVE_TTL_DAYS", 30)))
+MEMBERSHIP_CHECK_CONCURRENCY = int(os.getenv("MEMBERSHIP_CHECK_CONCURRENCY", 8))
+MEMBERSHIP_COLD_CHECK_LIMIT = int(os.getenv("MEMBERSHIP_COLD_CHECK_LIMIT", 20))
+INACTIVE_MEMBER_STATUSES = ('left', 'kicked', 'restricted')
+
+# Жеребьевка: сколько случайных циклов пробуем, прежде чем чинить назначение паросочетанием
+SANTA_CYCLE_ATTEMPTS = int(os.getenv("SANTA_CYCLE_ATTEMPTS", 20))
+# Жеребьевка идёт фоновым заданием: аренда (после падения процесса задание подхватит другой экземпляр) и число попыток
+SANTA_JOB_LEASE = timedelta(seconds=int(os.getenv("SANTA_JOB_LEASE_SECONDS", 120)))
+SANTA_JOB_MAX_ATTEMPTS = int(os.getenv("SANTA_JOB_MAX_ATTEMPTS", 3))
+SANTA_JOB_POLL_INTERVAL = float(os.getenv("SANTA_JOB_POLL_INTERVAL", 5))
+
+# Кэш имён пользователей (get_chat): размер, TTL и короткий TTL для ошибок
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", 10000))
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL", 3600))
+NAME_CACHE_ERROR_TTL = int(os.getenv("NAME_CACHE_ERROR_TTL", 120))
+NAME_LOOKUP_CONCURRENCY = int(os.getenv("NAME_LOOKUP_CONCURRENCY", 8))
+NAME_LOOKUP_RETRIES = int(os.getenv("NAME_LOOKUP_RETRIES", 3))  # сколько раз фоновая задача пережидает 429 на get_chat
+SANTA_STATE_MAX_GAMES = int(os.getenv("SANTA_STATE_MAX_GAMES", 20))
+
+# Списки "Мои сборы": размер страницы по умолчанию и потолок
+COLLECTIONS_PAGE_SIZE = int(os.getenv("COLLECTIONS_PAGE_SIZE", 20))
+COLLECTIONS_PAGE_MAX = int(os.getenv("COLLECTIONS_PAGE_MAX", 100))
+
+# Загрузка картинок: imgbb (адрес можно подменить для тестов), лимит размера, даунскейл через Pillow
+IMGBB_KEY = os.getenv("IMGBB_KEY", "7c11778e00b562e2dfd3a7ec7efe0d3e")
+IMGBB_UPLOAD_URL = os.getenv("IMGBB_UPLOAD_URL", "https://api.imgbb.com/1/upload")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_MAX_DIMENSION = int(os.getenv("UPLOAD_MAX_DIMENSION", 1600))
+UPLOAD_JPEG_QUALITY = int(os.getenv("UPLOAD_JPEG_QUALITY", 85))
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 50))
+
+# Кэш карточек сборов и ссылок на инвойсы
+COLLECTION_CACHE_SIZE = int(os.getenv("COLLECTION_CACHE_SIZE", 5000))
+COLLECTION_CACHE_TTL = int(os.getenv("COLLECTION_CACHE_TTL", 30))
+INVOICE_CACHE_SIZE = int(os.getenv("INVOICE_CACHE_SIZE", 5000))
+INVOICE_CACHE_TTL = int(os.getenv("INVOICE_CACHE_TTL", 120))
+
+# Приём платежей: окно склейки пачки по одному сбору, размер пачки и число повторов при ошибке БД (дальше — раз в час).
+# Платёж до записи в contributions лежит в pending_payments: аренда строки и период опроса цикла восстановления
+PAYMENT_BATCH_WINDOW = float(os.getenv("PAYMENT_BATCH_WINDOW_MS", 20)) / 1000
+PAYMENT_BATCH_MAX = int(os.getenv("PAYMENT_BATCH_MAX", 200))
+PAYMENT_RETRY_MAX = int(os.getenv("PAYMENT_RETRY_MAX", 8))
+PAYMENT_LEASE = timedelta(seconds=int(os.getenv("PAYMENT_LEASE_SECONDS", 30)))
+PAYMENT_POLL_INTERVAL = float(os.getenv("PAYMENT_POLL_INTERVAL", 5))
+
+# Прогресс сборов в реальном времени (SSE). Между репликами — LISTEN/NOTIFY (auto: если база умеет, CockroachDB не умеет),
+# иначе раз в COLLECTION_PUSH_POLL_SECONDS одним запросом перечитываем сборы, которые кто-то сейчас смотрит (0 — выкл.)
+COLLECTION_PUSH_NOTIFY = os.getenv("COLLECTION_PUSH_NOTIFY", "auto").lower()
+COLLECTION_PUSH_POLL_SECONDS = float(os.getenv("COLLECTION_PUSH_POLL_SECONDS", 3))
+COLLECTION_PUSH_CHANNEL = "giftflow_collection_progress"
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+SSE_MAX_CLIENTS = int(os.getenv("SSE_MAX_CLIENTS", 5000))
+SSE_MAX_PER_USER = int(os.getenv("SSE_MAX_PER_USER", 3))
+# EventSource не умеет заголовки, поэтому поток открывается по короткому токену из POST /api/collections/stream_token
+# (подписан ключом из BOT_TOKEN — проверит любая реплика), а не по initData в адресе, который попадает в access log
+SSE_TOKEN_TTL = int(os.getenv("SSE_TOKEN_TTL", 60))
+SSE_TOKEN_KEY = hashlib.sha256(f"sse:{BOT_TOKEN}".encode()).digest()
+
+# Очередь уведомлений: лимиты Telegram (~30 msg/s всего, 1 msg/s в личку, 20 msg/min в группу)
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", 4))
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", 5000))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", 25))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", 1))
+NOTIFY_GROUP_RATE_PER_MIN = float(os.getenv("NOTIFY_GROUP_RATE_PER_MIN", 20))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", 5))
+NOTIFY_LEASE = timedelta(seconds=int(os.getenv("NOTIFY_LEASE_SECONDS", 60)))
+NOTIFY_POLL_INTERVAL = float(os.getenv("NOTIFY_POLL_INTERVAL", 5))
+
+# Метрики: /metrics и /api/stats (внутренности пула и тексты запросов) — только с Authorization: Bearer METRICS_TOKEN,
+# без METRICS_TOKEN оба выключены (404). Плюс порог лога медленных запросов (0 — выкл.).
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 1000))
+
+# Защита /api/*: пользователь берётся из подписанного initData Mini App (WEBAPP_AUTH_REQUIRED=false — по-старому из chat_id,
+# только для локальной отладки), потолок тела запроса и token bucket на пользователя плюс отдельные лимиты дорогих маршрутов
+WEBAPP_AUTH_REQUIRED = os.getenv("WEBAPP_AUTH_REQUIRED", "true").lower() != "false"
+WEBAPP_AUTH_MAX_AGE = int(os.getenv("WEBAPP_AUTH_MAX_AGE", 86400))
+WEBAPP_AUTH_CACHE_TTL = int(os.getenv("WEBAPP_AUTH_CACHE_TTL", 600))
+API_MAX_BODY_BYTES = int(os.getenv("API_MAX_BODY_BYTES", 64 * 1024))
+API_USER_RATE = float(os.getenv("API_USER_RATE", 5))
+API_USER_BURST = float(os.getenv("API_USER_BURST", 20))
+# {"маршрут": [запросов в секунду, запас]}: /api/chats — не больше MEMBERSHIP_COLD_CHECK_LIMIT живых get_chat_member,
+# upload — imgbb, invoice — createInvoiceLink
+API_ROUTE_LIMITS = json.loads(os.getenv("API_ROUTE_LIMITS", '{"/api/chats": [1, 5], "/api/upload": [0.2, 3], "/api/collections/invoice": [1, 5], "/api/santa/start": [0.1, 2]}'))
+
+# Активность групп пишется пачками раз в GROUP_ACTIVITY_FLUSH_SECONDS. Обслуживание раз в MAINTENANCE_INTERVAL_SECONDS:
+# забываем группы без активности GROUP_IDLE_DAYS, перепроверяем присутствие бота в затихших группах,
+# архивируем разыгранные (SANTA_ARCHIVE_AFTER_DAYS) и брошенные в наборе (SANTA_RECRUITING_TTL_DAYS) игры
+GROUP_ACTIVITY_FLUSH_SECONDS = float(os.getenv("GROUP_ACTIVITY_FLUSH_SECONDS", 60))
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL_SECONDS", 3600))
+MAINTENANCE_BATCH = int(os.getenv("MAINTENANCE_BATCH", 500))
+GROUP_IDLE_TTL = timedelta(days=int(os.getenv("GROUP_IDLE_DAYS", 180)))
+GROUP_VERIFY_AFTER = timedelta(days=int(os.getenv("GROUP_VERIFY_AFTER_DAYS", 7)))
+GROUP_VERIFY_BATCH = int(os.getenv("GROUP_VERIFY_BATCH", 50))
+SANTA_ARCHIVE_AFTER = timedelta(days=int(os.getenv("SANTA_ARCHIVE_AFTER_DAYS", 60)))
+SANTA_RECRUITING_TTL = timedelta(days=int(os.getenv("SANTA_RECRUITING_TTL_DAYS", 90)))
+
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 BASE_DIR = PROJECT_ROOT
 # Для Render используем временную папку, если вдруг что-то надо сохранить
@@ -45,17 +188,20 @@ UPLOAD_DIR = os.path.join('/tmp', 'images')
 
 if not BOT_TOKEN: sys.exit("❌ Ошибка: Нет BOT_TOKEN")
 if not DATABASE_URL: sys.exit("❌ Ошибка: Нет DATABASE_URL")
+if BOT_MODE not in ('polling', 'webhook'): sys.exit(f"❌ Ошибка: BOT_MODE={BOT_MODE} (нужно polling или webhook)")
+if BOT_MODE == 'webhook' and not WEBHOOK_BASE_URL: sys.exit("❌ Ошибка: Нет WEBHOOK_BASE_URL для BOT_MODE=webhook")
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else None, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
 CORS_HEADERS = {
     "Access-Control-Allow-Origin": "*",
     "Access-Control-Allow-Methods": "POST, GET, OPTIONS, DELETE",
-    "Access-Control-Allow-Headers": "Content-Type",
+    "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Init-Data",
+    "Access-Control-Expose-Headers": "Retry-After",
     "Access-Control-Max-Age": "86400"
 }
 
@@ -67,13 +213,205 @@ def process_wishlist_links(text):
         return f'[{original_url}]({original_url})'
     return re.sub(URL_REGEX, replace_match, text)
 
-async def get_user_display_name(bot_instance: Bot, user_id: int):
-    try:
-        chat = await bot_instance.get_chat(user_id)
+class AsyncTTLCache:
+    # LRU + TTL в памяти процесса. Одновременные промахи по одному ключу ждут одну загрузку.
+    # Если задан fallback, ошибка отдаётся им; на error_ttl кэшируются только ошибки из cache_errors
+    # (постоянные — заблокировал бота, нет такого чата), временные не кэшируются.
+    def __init__(self, maxsize, ttl, error_ttl=0):
+        self.maxsize, self.ttl, self.error_ttl = maxsize, ttl, error_ttl
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._stale = set()
+        self.hits = self.misses = self.coalesced = self.errors = self.invalidations = 0
+
+    def _put(self, key, value, ttl):
+        if ttl <= 0: return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+    async def _load(self, key, loader, fallback, cache_errors):
+        task = asyncio.current_task()
+        try:
+            value = await loader()
+            ttl = self.ttl
+        except Exception as e:
+            self.errors += 1
+            if fallback is None: raise
+            value, ttl = fallback(e), self.error_ttl if isinstance(e, cache_errors) else 0
+        finally:
+            if self._inflight.get(key) is task: self._inflight.pop(key)
+        # Если ключ успели инвалидировать, пока шла загрузка, результат отдаём ждущим, но не кладём в кэш
+        if task in self._stale: self._stale.discard(task)
+        else: self._put(key, value, ttl)
+        return value
+
+    async def get_or_load(self, key, loader, fallback=None, cache_errors=()):
+        item = self._data.get(key)
+        if item:
+            if item[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._data[key]
+        task = self._inflight.get(key)
+        if task: self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._inflight[key] = asyncio.ensure_future(self._load(key, loader, fallback, cache_errors))
+        # shield: отмена одного ожидающего не должна отменять загрузку для остальных
+        return await asyncio.shield(task)
+
+    def peek(self, key):
+        item = self._data.get(key)
+        return item[1] if item and item[0] > time.monotonic() else None
+
+    def invalidate(self, key):
+        self.invalidations += 1
+        self._data.pop(key, None)
+        task = self._inflight.pop(key, None)
+        if task: self._stale.add(task)
+
+    def invalidate_where(self, predicate):
+        for key in [k for k in list(self._data) + list(self._inflight) if predicate(k)]: self.invalidate(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "errors": self.errors, "invalidations": self.invalidations, "inflight": len(self._inflight), "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated = capacity, time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    async def acquire(self):
+        # Резервируем токен сразу (баланс может уйти в минус), так ожидающие выстраиваются честно
+        self.take()
+        if self.tokens < 0: await asyncio.sleep(-self.tokens / self.rate)
+
+    def pause(self, seconds):
+        # Не суммируем: несколько воркеров, поймавших одну и ту же паузу, не должны её удлинять
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+name_cache = AsyncTTLCache(NAME_CACHE_SIZE, NAME_CACHE_TTL, NAME_CACHE_ERROR_TTL)
+# Снимки сборов и ссылки на инвойсы: кэш на процесс, инвалидируется при каждом изменении сбора
+collection_cache = AsyncTTLCache(COLLECTION_CACHE_SIZE, COLLECTION_CACHE_TTL)
+invoice_cache = AsyncTTLCache(INVOICE_CACHE_SIZE, INVOICE_CACHE_TTL)
+
+upload_cache = AsyncTTLCache(1000, 24 * 3600)
+
+def invalidate_collection(collection_id, invoices=False):
+    collection_cache.invalidate(int(collection_id))
+    if invoices: invoice_cache.invalidate_where(lambda k: k[0] == int(collection_id))
+
+async def get_user_display_name(bot_instance: Bot, user_id: int, wait_flood=False):
+    # wait_flood: фоновые задачи (жеребьевка) пережидают 429, а не пишут заглушку в текст навсегда
+    async def load():
+        for attempt in range(NAME_LOOKUP_RETRIES + 1):
+            try:
+                chat = await bot_instance.get_chat(user_id)
+                break
+            except TelegramRetryAfter as e:
+                if not wait_flood or attempt == NAME_LOOKUP_RETRIES: raise
+                await asyncio.sleep(e.retry_after)
         if chat.username: return f"@{chat.username}"
         elif chat.first_name: return chat.first_name
         else: return f"ID: {user_id}"
-    except: return f"Участник (ID: {user_id})"
+    return await name_cache.get_or_load(int(user_id), load, fallback=lambda e: f"Участник (ID: {user_id})", cache_errors=(TelegramBadRequest, TelegramForbiddenError))
+
+# ==========================================
+# 📊 МЕТРИКИ
+# ==========================================
+# Счётчики и гистограммы в памяти процесса, /metrics отдаёт их в текстовом формате Prometheus.
+# Внутри HTTP-запроса время БД, ожидания пула и вызовов Bot API дополнительно копится в request_phases —
+# из него собирается разбивка для лога медленных запросов.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+request_phases = contextvars.ContextVar('request_phases', default=None)
+
+def add_phase(name, elapsed):
+    phases = request_phases.get()
+    if phases is None: return
+    p = phases.get(name)
+    if p is None: phases[name] = [1, elapsed]
+    else: p[0] += 1; p[1] += elapsed
+
+def prom_labels(labels):
+    if not labels: return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in labels) + '}'
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        # Бакеты сразу накопительные, как их ждёт Prometheus; последние две ячейки — count и sum
+        h = self.histograms.get((name, labels))
+        if h is None: h = self.histograms[(name, labels)] = [0] * len(LATENCY_BUCKETS) + [0, 0.0]
+        for i, le in enumerate(LATENCY_BUCKETS):
+            if value <= le: h[i] += 1
+        h[-2] += 1; h[-1] += value
+
+    def render(self, extra=()):
+        # extra: [(name, 'gauge'|'counter', labels, value)] — снимаются с объектов в момент запроса
+        lines, typed = [], set()
+        def emit(name, kind, labels, value, suffix=''):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{suffix}{prom_labels(labels)} {value}")
+        for (name, labels), value in sorted(self.counters.items()): emit(name, 'counter', labels, value)
+        for (name, labels), h in sorted(self.histograms.items()):
+            for le, c in zip(LATENCY_BUCKETS, h): emit(name, 'histogram', labels + (('le', le),), c, '_bucket')
+            emit(name, 'histogram', labels + (('le', '+Inf'),), h[-2], '_bucket')
+            emit(name, 'histogram', labels, h[-2], '_count')
+            emit(name, 'histogram', labels, round(h[-1], 6), '_sum')
+        for name, kind, labels, value in extra: emit(name, kind, labels, value)
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+async def bot_api_metrics(make_request, bot_instance, method):
+    # Мидлварь сессии aiogram: время и исход каждого вызова Bot API (retry_after = ответ 429)
+    name, outcome = method.__api_method__, 'ok'
+    t0 = time.perf_counter()
+    try: return await make_request(bot_instance, method)
+    except TelegramRetryAfter:
+        outcome = 'retry_after'
+        raise
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        metrics.observe('giftflow_bot_api_request_duration_seconds', (('method', name),), elapsed)
+        metrics.inc('giftflow_bot_api_requests_total', (('method', name), ('outcome', outcome)))
+        add_phase('bot_api', elapsed)
+
+bot.session.middleware(bot_api_metrics)
 
 # ==========================================
 # 🗄️ БАЗА ДАННЫХ
@@ -88,6 +426,8 @@ CREATE TABLE IF NOT EXISTS public.collections (
 CREATE TABLE IF NOT EXISTS public.contributions (
     id SERIAL PRIMARY KEY, collection_id INT NOT NULL REFERENCES public.collections(id), user_id BIGINT NOT NULL, amount INT NOT NULL, currency TEXT NOT NULL, telegram_payment_charge_id TEXT, created_at TIMESTAMP DEFAULT NOW()
 );
+CREATE INDEX IF NOT EXISTS idx_collections_creator_created ON public.collections (creator_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_contributions_user_collection ON public.contributions (user_id, collection_id);
 CREATE TABLE IF NOT EXISTS public.santa_games (
     id SERIAL PRIMARY KEY,
     creator_id BIGINT NOT NULL,
@@ -103,41 +443,841 @@ CREATE TABLE IF NOT EXISTS public.santa_participants (
     target_user_id BIGINT,
     UNIQUE(game_id, user_id)
 );
+CREATE INDEX IF NOT EXISTS idx_santa_participants_user ON public.santa_participants (user_id);
+CREATE INDEX IF NOT EXISTS idx_santa_participants_target ON public.santa_participants (game_id, target_user_id);
+CREATE TABLE IF NOT EXISTS public.santa_exclusions (
+    game_id INT NOT NULL REFERENCES public.santa_games(id) ON DELETE CASCADE,
+    giver_id BIGINT NOT NULL,
+    receiver_id BIGINT NOT NULL,
+    PRIMARY KEY (game_id, giver_id, receiver_id)
+);
+CREATE TABLE IF NOT EXISTS public.notification_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    text TEXT NOT NULL,
+    reply_markup TEXT,
+    attempts INT DEFAULT 0,
+    next_attempt_at TIMESTAMP DEFAULT NOW(),
+    job_id BIGINT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON public.notification_outbox (next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_job ON public.notification_outbox (job_id);
+CREATE TABLE IF NOT EXISTS public.pending_payments (
+    telegram_payment_charge_id TEXT PRIMARY KEY,
+    collection_id INT NOT NULL,
+    user_id BIGINT NOT NULL,
+    amount INT NOT NULL,
+    currency TEXT NOT NULL,
+    attempts INT DEFAULT 0,
+    error TEXT,
+    next_attempt_at TIMESTAMP DEFAULT NOW(),
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_pending_payments_due ON public.pending_payments (next_attempt_at);
+CREATE TABLE IF NOT EXISTS public.uploaded_images (
+    sha256 TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS public.chat_members (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_chat_members_user ON public.chat_members (user_id, chat_id);
+CREATE INDEX IF NOT EXISTS idx_chat_members_updated ON public.chat_members (updated_at);
+CREATE INDEX IF NOT EXISTS idx_known_group_chats_active ON public.known_group_chats (last_active);
+CREATE TABLE IF NOT EXISTS public.santa_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    game_id INT NOT NULL,
+    creator_id BIGINT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INT DEFAULT 0,
+    total INT DEFAULT 0,
+    failed INT DEFAULT 0,
+    error TEXT,
+    lease_until TIMESTAMP DEFAULT NOW(),
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_santa_jobs_game ON public.santa_jobs (game_id);
+CREATE INDEX IF NOT EXISTS idx_santa_jobs_status ON public.santa_jobs (status, lease_until);
+CREATE TABLE IF NOT EXISTS public.santa_participants_archive (
+    game_id INT NOT NULL,
+    user_id BIGINT NOT NULL,
+    wishlist TEXT,
+    target_user_id BIGINT,
+    archived_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (game_id, user_id)
+);
 """
 
+# Горячие запросы (вызываются по имени через conn.fetch_named / fetchrow_named)
+COMMON_CHATS_SQL = """SELECT k.chat_id, k.title, m.status, (m.updated_at > NOW() - CASE WHEN m.status = ANY($4::TEXT[]) THEN $3::INTERVAL ELSE $2::INTERVAL END) AS fresh
+    FROM public.known_group_chats k LEFT JOIN public.chat_members m ON m.chat_id = k.chat_id AND m.user_id = $1 ORDER BY k.last_active DESC NULLS LAST"""
+COLLECTION_BY_ID_SQL = "SELECT * FROM public.collections WHERE id = $1"
+SANTA_STATE_SQL = """SELECT p.game_id, p.wishlist, p.target_user_id, g.title, g.status AS game_status, g.creator_id,
+    (SELECT COUNT(*) FROM public.santa_participants c WHERE c.game_id = p.game_id) AS participants_count,
+    t.user_id AS target_id, t.wishlist AS target_wishlist
+    FROM public.santa_participants p JOIN public.santa_games g ON p.game_id = g.id
+    LEFT JOIN public.santa_participants t ON t.game_id = p.game_id AND t.user_id = p.target_user_id
+    WHERE p.user_id = $1 AND g.status IN ('recruiting', 'active') ORDER BY g.created_at DESC LIMIT $2"""
+# Вклад и пересчёт суммы/статуса — одним выражением. Повтор telegram_payment_charge_id гасится
+# уникальным индексом, just_finished истинно ровно у той пачки, что перевалила через цель.
+INGEST_CONTRIBUTIONS_SQL = """WITH ins AS (
+    INSERT INTO public.contributions (collection_id, user_id, amount, currency, telegram_payment_charge_id)
+    SELECT $1, u, a, c, ch FROM UNNEST($2::BIGINT[], $3::INT[], $4::TEXT[], $5::TEXT[]) AS t(u, a, c, ch)
+    ON CONFLICT (telegram_payment_charge_id) DO NOTHING RETURNING amount
+), delta AS (SELECT COUNT(*) AS n, COALESCE(SUM(amount), 0)::INT AS total FROM ins)
+UPDATE public.collections c SET current_amount = c.current_amount + d.total,
+    status = CASE WHEN c.status = 'active' AND c.current_amount + d.total >= c.amount THEN 'finished' ELSE c.status END
+FROM delta d WHERE c.id = $1 AND d.n > 0
+RETURNING c.current_amount, c.amount, c.goal, c.target_chat_id, c.status, d.n AS inserted, (c.status = 'finished' AND c.current_amount - d.total < c.amount) AS just_finished"""
+# Keyset-пагинация по (created_at, id); первая страница — с "бесконечным" курсором
+MY_CREATED_SQL = """SELECT id, goal, amount, current_amount, status, created_at FROM public.collections
+    WHERE creator_id = $1 AND (created_at, id) < ($2::TIMESTAMP, $3::INT) ORDER BY created_at DESC, id DESC LIMIT $4"""
+MY_PARTICIPATED_SQL = """SELECT c.id, c.goal, c.amount, c.current_amount, c.status, c.created_at FROM public.collections c
+    WHERE EXISTS (SELECT 1 FROM public.contributions cb WHERE cb.user_id = $1 AND cb.collection_id = c.id) AND c.creator_id != $1
+    AND (c.created_at, c.id) < ($2::TIMESTAMP, $3::INT) ORDER BY c.created_at DESC, c.id DESC LIMIT $4"""
+HOT_QUERIES = {
+    'common_chats': COMMON_CHATS_SQL,
+    'collection_by_id': COLLECTION_BY_ID_SQL,
+    'santa_state': SANTA_STATE_SQL,
+    'my_created': MY_CREATED_SQL,
+    'my_participated': MY_PARTICIPATED_SQL,
+    'ingest_contributions': INGEST_CONTRIBUTIONS_SQL,
+}
+
+class DbStats:
+    def __init__(self):
+        self.acquires = self.acquire_timeouts = self.in_use = self.peak_in_use = self.waiting = 0
+        self.acquire_wait_total = self.acquire_wait_max = 0.0
+        self.queries = {}
+        self._labels = {}
+
+    def label(self, query):
+        lbl = self._labels.get(query)
+        if lbl is None:
+            lbl = ' '.join(query.split())[:80]
+            if len(self._labels) < 1000: self._labels[query] = lbl
+        return lbl
+
+    def record_query(self, label, elapsed):
+        q = self.queries.get(label)
+        if q is None: q = self.queries[label] = [0, 0.0, 0.0]
+        q[0] += 1; q[1] += elapsed; q[2] = max(q[2], elapsed)
+
+    def snapshot(self, pool):
+        top = sorted(self.queries.items(), key=lambda kv: kv[1][1], reverse=True)[:20]
+        return {
+            "size": pool.get_size(), "idle": pool.get_idle_size(), "max_size": pool.get_max_size(), "in_use": self.in_use, "peak_in_use": self.peak_in_use,
+            "utilisation": round(self.in_use / pool.get_max_size(), 3), "waiting": self.waiting, "acquires": self.acquires, "acquire_timeouts": self.acquire_timeouts,
+            "acquire_wait_avg_ms": round(self.acquire_wait_total / self.acquires * 1000, 3) if self.acquires else 0.0, "acquire_wait_max_ms": round(self.acquire_wait_max * 1000, 3),
+            "queries": [{"query": lbl, "count": c, "avg_ms": round(t / c * 1000, 3), "max_ms": round(m * 1000, 3)} for lbl, (c, t, m) in top],
+        }
+
+db_stats = DbStats()
+
+class GiftflowConnection(asyncpg.Connection):
+    # Замер каждого запроса; горячие запросы из HOT_QUERIES вызываются по имени
+    async def _timed(self, label, coro):
+        t0 = time.perf_counter()
+        try: return await coro
+        finally:
+            elapsed = time.perf_counter() - t0
+            db_stats.record_query(label, elapsed)
+            metrics.observe('giftflow_db_query_duration_seconds', (), elapsed)
+            add_phase('db', elapsed)
+
+    async def execute(self, query, *args, **kwargs): return await self._timed(db_stats.label(query), super().execute(query, *args, **kwargs))
+    async def executemany(self, command, args, **kwargs): return await self._timed(db_stats.label(command), super().executemany(command, args, **kwargs))
+    async def fetch(self, query, *args, **kwargs): return await self._timed(db_stats.label(query), super().fetch(query, *args, **kwargs))
+    async def fetchrow(self, query, *args, **kwargs): return await self._timed(db_stats.label(query), super().fetchrow(query, *args, **kwargs))
+    async def fetchval(self, query, *args, **kwargs): return await self._timed(db_stats.label(query), super().fetchval(query, *args, **kwargs))
+
+    # asyncpg держит серверные prepared statements в кэше соединения (statement_cache_size),
+    # поэтому горячий запрос по имени готовится один раз на соединение и дальше только исполняется
+    async def fetch_named(self, name, *args): return await self._timed(name, super().fetch(HOT_QUERIES[name], *args))
+    async def fetchrow_named(self, name, *args): return await self._timed(name, super().fetchrow(HOT_QUERIES[name], *args))
+
+class InstrumentedPool:
+    # Тонкая обёртка над asyncpg.Pool: считает ожидание acquire и занятость; остальное проксирует
+    def __init__(self, pool): self._pool = pool
+
+    def __getattr__(self, name): return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self):
+        t0 = time.perf_counter()
+        db_stats.waiting += 1
+        try: conn = await self._pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            db_stats.acquire_timeouts += 1
+            raise
+        finally: db_stats.waiting -= 1
+        wait = time.perf_counter() - t0
+        db_stats.acquires += 1; db_stats.acquire_wait_total += wait; db_stats.acquire_wait_max = max(db_stats.acquire_wait_max, wait)
+        metrics.observe('giftflow_db_pool_acquire_seconds', (), wait)
+        add_phase('pool_wait', wait)
+        db_stats.in_use += 1; db_stats.peak_in_use = max(db_stats.peak_in_use, db_stats.in_use)
+        try: yield conn
+        finally:
+            db_stats.in_use -= 1
+            await self._pool.release(conn)
+
+    def stats(self): return db_stats.snapshot(self._pool)
+
 async def create_db_pool():
     try:
         # Стандартное подключение для Render/CockroachDB
         pool = await asyncpg.create_pool(
             dsn=DATABASE_URL,
-            min_size=1, 
-            max_size=4, 
-            server_settings={'multiple_active_portals_enabled': 'true'}
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            connection_class=GiftflowConnection,
+            server_settings=DB_SERVER_SETTINGS
         )
         async with pool.acquire() as conn:
             await conn.execute(INIT_SQL)
             try: await conn.execute("ALTER TABLE public.collections ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'active';")
             except: pass
+            try: await conn.execute("ALTER TABLE public.known_group_chats ADD COLUMN IF NOT EXISTS verified_at TIMESTAMP;")
+            except: pass
+            try: await conn.execute("ALTER TABLE public.santa_games ADD COLUMN IF NOT EXISTS started_at TIMESTAMP;")
+            except: pass
+            try: await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_contributions_charge ON public.contributions (telegram_payment_charge_id);")
+            except Exception as e:
+                # Без индекса ON CONFLICT в ingest_contributions падает на каждом платеже — лучше не стартовать вовсе,
+                # дубли по charge_id надо разобрать руками (это деньги, молча удалять их нельзя)
+                logging.critical(f"❌ Unique index on telegram_payment_charge_id failed (duplicates?): {e}")
+                sys.exit(1)
         logging.info("✅ Database pool created.")
-        return pool
+        return InstrumentedPool(pool)
     except Exception as e:
         logging.critical(f"❌ DB Error: {e}")
         sys.exit(1)
 
+# ==========================================
+# 📬 ОЧЕРЕДЬ УВЕДОМЛЕНИЙ
+# ==========================================
+# Сообщения сначала пишутся в notification_outbox (можно внутри чужой транзакции), потом раздаются воркерам.
+# Строка "занята" процессом, пока next_attempt_at в будущем: воркеры продлевают аренду, после падения
+# процесса её подберёт любой живой экземпляр. Удаляется строка только после успешной отправки.
+class NotificationQueue:
+    def __init__(self, bot_instance, pool):
+        self.bot, self.pool = bot_instance, pool
+        self.queue = asyncio.Queue(NOTIFY_QUEUE_SIZE)
+        self.global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.queued = set()
+        self.sent = self.failed = self.retried = 0
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(NOTIFY_WORKERS)]
+        self._tasks.append(asyncio.create_task(self._recover_loop()))
+
+    async def stop(self):
+        for t in self._tasks: t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    @staticmethod
+    async def persist(conn, items, job_id=None):
+        # items: [(chat_id, text, reply_markup)]; вызывать можно внутри транзакции, раздавать — после коммита.
+        # job_id связывает строки с заданием (santa_jobs), чтобы считать, сколько из них ещё не отправлено
+        items = [(int(c), t, m.model_dump_json(exclude_none=True) if m else None) for c, t, m in items]
+        if not items: return []
+        return await conn.fetch("""INSERT INTO public.notification_outbox (chat_id, text, reply_markup, next_attempt_at, job_id) SELECT c, t, m, NOW() + $4::INTERVAL, $5::BIGINT FROM UNNEST($1::BIGINT[], $2::TEXT[], $3::TEXT[]) AS u(c, t, m) RETURNING id, chat_id, text, reply_markup, attempts""", [i[0] for i in items], [i[1] for i in items], [i[2] for i in items], NOTIFY_LEASE, job_id)
+
+    def dispatch(self, rows):
+        for r in rows:
+            if r['id'] in self.queued: continue
+            try: self.queue.put_nowait(dict(r))
+            except asyncio.QueueFull: return  # остальное подберёт _recover_loop, когда истечёт аренда
+            self.queued.add(r['id'])
+
+    async def enqueue_many(self, items):
+        async with self.pool.acquire() as conn:
+            rows = await self.persist(conn, items)
+        self.dispatch(rows)
+
+    async def enqueue(self, chat_id, text, reply_markup=None):
+        await self.enqueue_many([(chat_id, text, reply_markup)])
+
+    def _bucket(self, chat_id):
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            b = self.chat_buckets[chat_id] = TokenBucket(NOTIFY_GROUP_RATE_PER_MIN / 60, 3) if chat_id < 0 else TokenBucket(NOTIFY_CHAT_RATE, 1)
+        return b
+
+    async def _reschedule(self, item, delay, failed_attempt):
+        # Держим аренду ещё NOTIFY_LEASE после срока, чтобы другой экземпляр не схватил строку раньше нас
+        async with self.pool.acquire() as conn:
+            await conn.execute("UPDATE public.notification_outbox SET attempts = attempts + $2, next_attempt_at = NOW() + $3::INTERVAL WHERE id = $1", item['id'], int(failed_attempt), timedelta(seconds=delay) + NOTIFY_LEASE)
+        item['attempts'] += int(failed_attempt)
+        self.retried += 1
+        asyncio.get_running_loop().call_later(delay, self.dispatch, [item])
+
+    async def _done(self, item, failed=False):
+        async with self.pool.acquire() as conn:
+            if not failed: return await conn.execute("DELETE FROM public.notification_outbox WHERE id = $1", item['id'])
+            # Недоставленное сообщение задания засчитываем в santa_jobs.failed тем же запросом, что и удаляем:
+            # повторная попытка удаления (другой экземпляр, повтор после сбоя) ничего не удалит и не досчитает
+            await conn.execute("WITH d AS (DELETE FROM public.notification_outbox WHERE id = $1 RETURNING job_id) UPDATE public.santa_jobs SET failed = failed + 1, updated_at = NOW() WHERE id = (SELECT job_id FROM d)", item['id'])
+
+    async def _deliver(self, item):
+        chat_id = item['chat_id']
+        bucket = self._bucket(chat_id)
+        wait = bucket.wait_time()
+        if wait > 1: return await self._reschedule(item, wait, False)
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+        markup = InlineKeyboardMarkup.model_validate_json(item['reply_markup']) if item['reply_markup'] else None
+        try:
+            await self.bot.send_message(chat_id, item['text'], reply_markup=markup)
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+            # Флуд-лимит в личке — общий на бота: стопорим и остальных воркеров, а не только этот чат
+            if chat_id > 0: self.global_bucket.pause(e.retry_after)
+            return await self._reschedule(item, e.retry_after, False)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            logging.warning(f"Notification to {chat_id} dropped: {e}")
+            self.failed += 1
+            return await self._done(item, failed=True)
+        except Exception as e:
+            if item['attempts'] + 1 >= NOTIFY_MAX_ATTEMPTS:
+                logging.error(f"Notification to {chat_id} dropped after {item['attempts'] + 1} attempts: {e}")
+                self.failed += 1
+                return await self._done(item, failed=True)
+            return await self._reschedule(item, min(300, 5 * 2 ** item['attempts']), True)
+        self.sent += 1
+        await self._done(item)
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try: await self._deliver(item)
+            except Exception as e: logging.error(f"Notification worker error: {e}")
+            finally:
+                self.queued.discard(item['id'])
+                self.queue.task_done()
+
+    async def _recover_loop(self):
+        while True:
+            await asyncio.sleep(NOTIFY_POLL_INTERVAL)
+            try:
+                async with self.pool.acquire() as conn:
+                    if self.queued:
+                        await conn.execute("UPDATE public.notification_outbox SET next_attempt_at = NOW() + $2::INTERVAL WHERE id = ANY($1::BIGINT[])", list(self.queued), NOTIFY_LEASE)
+                    free = self.queue.maxsize - self.queue.qsize()
+                    rows = await conn.fetch("""UPDATE public.notification_outbox SET next_attempt_at = NOW() + $1::INTERVAL WHERE id IN (SELECT id FROM public.notification_outbox WHERE next_attempt_at <= NOW() ORDER BY id LIMIT $2 FOR UPDATE SKIP LOCKED) RETURNING id, chat_id, text, reply_markup, attempts""", NOTIFY_LEASE, free) if free > 0 else []
+                self.dispatch(rows)
+                if len(self.chat_buckets) > 10000:
+                    self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if not b.idle()}
+            except Exception as e: logging.error(f"Notification recovery error: {e}")
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "in_memory": len(self.queued), "sent": self.sent, "failed": self.failed, "retried": self.retried}
+
+# ==========================================
+# 📡 ПРОГРЕСС СБОРОВ В РЕАЛЬНОМ ВРЕМЕНИ
+# ==========================================
+def collection_progress(collection_id, current, amount, status):
+    return {"id": str(collection_id), "current": current, "amount": amount, "percent": int((current / amount) * 100) if amount > 0 else 0, "status": status or 'active'}
+
+class CollectionHub:
+    # Pub/sub в памяти процесса: у каждого SSE-клиента очередь на одно значение — важен только последний прогресс,
+    # промежуточные вытесняются. Другие реплики узнают о вкладах через NOTIFY (уходит вместе с коммитом пачки),
+    # а если LISTEN недоступен — через общий для всех зрителей опрос только просматриваемых сборов.
+    # Умеет ли база NOTIFY, решается один раз на старте: потеряв свой LISTEN, реплика продолжает слать NOTIFY
+    # (остальные реплики ждут их и не опрашивают базу), сама на время переподключения переходит на опрос.
+    def __init__(self, pool):
+        self.pool = pool
+        self.instance_id = uuid.uuid4().hex
+        self.subscribers = {}
+        self.per_user = {}
+        self.last = {}
+        self.clients = 0
+        self.closed = False
+        self.mode = 'local'
+        self.notify_enabled = False
+        self.listen_conn = None
+        self.published = self.delivered = self.superseded = self.remote = self.reconnects = 0
+        self._task = self._reconnect_task = None
+
+    async def start(self):
+        if COLLECTION_PUSH_NOTIFY != 'off':
+            try:
+                await self._listen()
+                self.notify_enabled = True
+            except Exception as e:
+                logging.log(logging.ERROR if COLLECTION_PUSH_NOTIFY == 'on' else logging.INFO, f"📡 LISTEN/NOTIFY unavailable ({e}), collection progress falls back to polling")
+        if self.mode != 'notify': self._start_polling()
+        logging.info(f"📡 Collection progress push: {self.mode}")
+
+    async def _listen(self):
+        conn = await asyncpg.connect(DATABASE_URL, server_settings=DB_SERVER_SETTINGS)
+        try: await conn.add_listener(COLLECTION_PUSH_CHANNEL, self._on_notify)
+        except Exception:
+            await conn.close()
+            raise
+        conn.add_termination_listener(self._on_listen_lost)
+        self.listen_conn, self.mode = conn, 'notify'
+
+    def _start_polling(self):
+        self.mode = 'poll' if COLLECTION_PUSH_POLL_SECONDS > 0 else 'local'
+        if self.mode == 'poll' and not self._task: self._task = asyncio.create_task(self._poll_loop())
+
+    def _on_listen_lost(self, conn):
+        if self.closed: return
+        logging.error("📡 LISTEN connection lost, polling collection progress until it is back")
+        self.listen_conn = None
+        self._start_polling()
+        if not self._reconnect_task: self._reconnect_task = asyncio.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        delay = 1
+        while not self.closed:
+            await asyncio.sleep(delay)
+            try: await self._listen()
+            except Exception as e:
+                delay = min(60, delay * 2)
+                logging.warning(f"📡 LISTEN reconnect failed, next try in {delay}s: {e}")
+                continue
+            self.reconnects += 1
+            self._reconnect_task = None
+            if self._task:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                self._task = None
+            # NOTIFY, пришедшие без слушателя, потеряны: один проход опроса догоняет просматриваемые сборы
+            await self._poll_once()
+            logging.info("📡 LISTEN connection restored")
+            return
+
+    async def close(self):
+        # Завершаем все SSE-ответы, иначе остановка сервера ждала бы их до таймаута
+        self.closed = True
+        for queues in self.subscribers.values():
+            for q in queues:
+                while not q.empty(): q.get_nowait()
+                q.put_nowait(None)
+        tasks = [t for t in (self._task, self._reconnect_task) if t]
+        for t in tasks: t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.listen_conn: await self.listen_conn.close()
+
+    def subscribe(self, collection_id, user_key):
+        if self.closed or self.clients >= SSE_MAX_CLIENTS or self.per_user.get(user_key, 0) >= SSE_MAX_PER_USER: return None
+        q = asyncio.Queue(1)
+        self.clients += 1
+        self.subscribers.setdefault(collection_id, set()).add(q)
+        self.per_user[user_key] = self.per_user.get(user_key, 0) + 1
+        return q
+
+    def unsubscribe(self, collection_id, q, user_key):
+        queues = self.subscribers.get(collection_id)
+        if queues is not None:
+            queues.discard(q)
+            if not queues:
+                del self.subscribers[collection_id]
+                self.last.pop(collection_id, None)
+        self.clients -= 1
+        n = self.per_user.get(user_key, 0) - 1
+        if n > 0: self.per_user[user_key] = n
+        else: self.per_user.pop(user_key, None)
+
+    def _fanout(self, collection_id, data):
+        if self.closed: return
+        self.last[collection_id] = data
+        for q in self.subscribers.get(collection_id, ()):
+            if q.full():
+                q.get_nowait()
+                self.superseded += 1
+            q.put_nowait(data)
+            self.delivered += 1
+
+    async def notify(self, conn, collection_id, data):
+        # Вызывать внутри транзакции записи: NOTIFY уйдёт другим репликам только после коммита
+        if self.notify_enabled:
+            await conn.execute("SELECT pg_notify($1, $2)", COLLECTION_PUSH_CHANNEL, json.dumps({"origin": self.instance_id, "id": int(collection_id), "data": data}))
+
+    def publish(self, collection_id, data):
+        self.published += 1
+        self._fanout(int(collection_id), data)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try: msg = json.loads(payload)
+        except ValueError: return
+        if msg.get('origin') == self.instance_id: return
+        self.remote += 1
+        invalidate_collection(msg['id'])
+        self._fanout(msg['id'], msg['data'])
+
+    async def _poll_once(self):
+        if not self.subscribers: return
+        try:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch("SELECT id, current_amount, amount, status FROM public.collections WHERE id = ANY($1::INT[])", list(self.subscribers))
+            for r in rows:
+                data = collection_progress(r['id'], r['current_amount'], r['amount'], r['status'])
+                if self.last.get(r['id']) != data:
+                    invalidate_collection(r['id'])
+                    self._fanout(r['id'], data)
+        except Exception as e: logging.error(f"Collection progress poll failed: {e}")
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(COLLECTION_PUSH_POLL_SECONDS)
+            await self._poll_once()
+
+    def stats(self):
+        return {"mode": self.mode, "notify": self.notify_enabled, "reconnects": self.reconnects, "clients": self.clients, "collections": len(self.subscribers), "published": self.published, "remote": self.remote, "delivered": self.delivered, "superseded": self.superseded}
+
+# ==========================================
+# 💰 ПРИЁМ ПЛАТЕЖЕЙ
+# ==========================================
+class ContributionIngestor:
+    # Платёж сначала ложится в pending_payments, и только потом апдейт считается обработанным (иначе Telegram его повторит).
+    # Дальше платежи в один сбор копятся PAYMENT_BATCH_WINDOW и пишутся одной транзакцией вместе с удалением из
+    # pending_payments (одна блокировка горячей строки на пачку). Строка "занята", пока next_attempt_at в будущем:
+    # упавшую пачку откладываем там же с экспоненциальной задержкой, а её и платежи упавшего процесса забирает
+    # _recover_loop любого экземпляра. В памяти платёж живёт только как копия того, что уже сохранено.
+    def __init__(self, pool, notifier, hub):
+        self.pool, self.notifier, self.hub = pool, notifier, hub
+        self.pending = {}
+        self.tasks = set()
+        self.ingested = self.duplicates = self.batches = self.retries = self.parked = self.recovered = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._recover_loop())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def submit(self, collection_id, user_id, amount, currency, charge_id):
+        # Несколько быстрых попыток: в режиме polling повтора апдейта не будет, в webhook исключение отдаст Telegram 500
+        for attempt in range(3):
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute("INSERT INTO public.pending_payments (telegram_payment_charge_id, collection_id, user_id, amount, currency, next_attempt_at) VALUES ($1, $2, $3, $4, $5, NOW() + $6::INTERVAL) ON CONFLICT (telegram_payment_charge_id) DO NOTHING", charge_id, int(collection_id), int(user_id), int(amount), currency, PAYMENT_LEASE)
+                break
+            except Exception as e:
+                if attempt == 2:
+                    logging.critical(f"❌ Payment NOT persisted (collection {collection_id}, user {user_id}, {amount} {currency}, {charge_id}): {e}")
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        batch = self.pending.get(collection_id)
+        if batch is None:
+            batch = self.pending[collection_id] = {}
+            self._spawn(self._flush_later(collection_id))
+        batch[charge_id] = (int(user_id), int(amount), currency, charge_id)
+        if len(batch) >= PAYMENT_BATCH_MAX: self._spawn(self._write(collection_id, list(self.pending.pop(collection_id).values())))
+
+    async def _flush_later(self, collection_id):
+        await asyncio.sleep(PAYMENT_BATCH_WINDOW)
+        batch = self.pending.pop(collection_id, None)
+        if batch: await self._write(collection_id, list(batch.values()))
+
+    async def _write(self, collection_id, payments):
+        try:
+            outbox = []
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    res = await conn.fetchrow_named('ingest_contributions', collection_id, [p[0] for p in payments], [p[1] for p in payments], [p[2] for p in payments], [p[3] for p in payments])
+                    progress = collection_progress(collection_id, res['current_amount'], res['amount'], res['status']) if res else None
+                    if progress: await self.hub.notify(conn, collection_id, progress)
+                    if res and res['just_finished']:
+                        outbox = await NotificationQueue.persist(conn, [(res['target_chat_id'], f"🎉 <b>СБОР ЗАВЕРШЕН!</b>\nЦель «{html.escape(res['goal'])}» достигнута! Собрано {res['current_amount']} ⭐", None)])
+                    await conn.execute("DELETE FROM public.pending_payments WHERE telegram_payment_charge_id = ANY($1::TEXT[])", [p[3] for p in payments])
+            invalidate_collection(collection_id)
+            if progress: self.hub.publish(collection_id, progress)
+            self.notifier.dispatch(outbox)
+            inserted = res['inserted'] if res else 0
+            self.batches += 1; self.ingested += inserted; self.duplicates += len(payments) - inserted
+        except Exception as e: await self._postpone(collection_id, payments, e)
+
+    async def _postpone(self, collection_id, payments, error):
+        # Строки остаются в pending_payments: сдвигаем срок (0.5с, 1с, 2с ... до минуты), после PAYMENT_RETRY_MAX
+        # попыток или при нарушении ограничения (сбор удалён и т.п.) — раз в час, пока кто-нибудь не разберётся
+        self.retries += 1
+        fatal = isinstance(error, asyncpg.IntegrityConstraintViolationError)
+        try:
+            async with self.pool.acquire() as conn:
+                attempts = await conn.fetchval("""UPDATE public.pending_payments SET attempts = attempts + 1, error = $2,
+                    next_attempt_at = NOW() + INTERVAL '1 second' * (CASE WHEN $3 OR attempts + 1 >= $4 THEN 3600 ELSE LEAST(60, 0.5 * POWER(2, attempts)) END)::FLOAT8
+                    WHERE telegram_payment_charge_id = ANY($1::TEXT[]) RETURNING attempts""", [p[3] for p in payments], str(error), fatal, PAYMENT_RETRY_MAX)
+        except Exception as e:
+            # Не смогли даже отложить — строки подберёт _recover_loop по истечении аренды
+            logging.error(f"Contribution batch for {collection_id} failed ({error}), postpone failed too: {e}")
+            return
+        if fatal or (attempts or 0) >= PAYMENT_RETRY_MAX:
+            self.parked += len(payments)
+            logging.critical(f"❌ Contributions NOT saved after {attempts} attempts (collection {collection_id}), kept in pending_payments: {payments}: {error}")
+        else: logging.error(f"Contribution batch for {collection_id} failed (attempt {attempts}), will retry: {error}")
+
+    async def _recover_loop(self):
+        while True:
+            await asyncio.sleep(PAYMENT_POLL_INTERVAL)
+            try:
+                async with self.pool.acquire() as conn:
+                    rows = await conn.fetch("""UPDATE public.pending_payments SET next_attempt_at = NOW() + $1::INTERVAL WHERE telegram_payment_charge_id IN (SELECT telegram_payment_charge_id FROM public.pending_payments WHERE next_attempt_at <= NOW() ORDER BY next_attempt_at LIMIT $2 FOR UPDATE SKIP LOCKED) RETURNING telegram_payment_charge_id, collection_id, user_id, amount, currency""", PAYMENT_LEASE, PAYMENT_BATCH_MAX)
+                groups = {}
+                for r in rows: groups.setdefault(r['collection_id'], []).append((r['user_id'], r['amount'], r['currency'], r['telegram_payment_charge_id']))
+                self.recovered += len(rows)
+                for collection_id, payments in groups.items(): self._spawn(self._write(collection_id, payments))
+            except Exception as e: logging.error(f"Contribution recovery error: {e}")
+
+    async def drain(self):
+        # Всё, что не успеет записаться, останется в pending_payments и уйдёт после рестарта через _recover_loop
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for collection_id in list(self.pending):
+            self._spawn(self._write(collection_id, list(self.pending.pop(collection_id).values())))
+        if self.tasks: await asyncio.wait(list(self.tasks), timeout=10)
+
+    def stats(self):
+        return {"pending": sum(len(b) for b in self.pending.values()), "inflight": len(self.tasks), "ingested": self.ingested, "duplicates": self.duplicates, "batches": self.batches, "retries": self.retries, "parked": self.parked, "recovered": self.recovered}
+
+# ==========================================
+# 🧹 АКТИВНОСТЬ ГРУПП И ОБСЛУЖИВАНИЕ
+# ==========================================
+class ActivityTracker:
+    # Сообщения в группах только отмечаются в памяти, раз в GROUP_ACTIVITY_FLUSH_SECONDS одна пачка обновляет
+    # last_active всех затронутых групп и членство написавших. Членство одного и того же человека переписываем
+    # не чаще раза в четверть MEMBERSHIP_TTL — запись и так остаётся свежей.
+    def __init__(self, pool):
+        self.pool = pool
+        self.chats = {}
+        self.members = set()
+        self.member_written = {}
+        self.touches = self.flushes = self.chat_writes = self.member_writes = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+    def touch(self, chat_id, title, user_id=None):
+        self.touches += 1
+        self.chats[int(chat_id)] = title
+        if user_id:
+            key = (int(chat_id), int(user_id))
+            written = self.member_written.get(key)
+            if written is None or time.monotonic() - written > MEMBERSHIP_TTL.total_seconds() / 4: self.members.add(key)
+
+    def forget(self, chat_ids):
+        # Бот вышел из группы: несброшенные отметки не должны вернуть её в known_group_chats
+        gone = set(chat_ids)
+        for c in gone: self.chats.pop(c, None)
+        self.members = {k for k in self.members if k[0] not in gone}
+        self.member_written = {k: t for k, t in self.member_written.items() if k[0] not in gone}
+
+    async def flush(self):
+        chats, self.chats = self.chats, {}
+        members, self.members = self.members, set()
+        if not chats and not members: return
+        try:
+            if chats:
+                ids = list(chats)
+                async with self.pool.acquire() as conn:
+                    await conn.execute("""INSERT INTO public.known_group_chats (chat_id, title, last_active) SELECT c, t, NOW() FROM UNNEST($1::BIGINT[], $2::TEXT[]) AS u(c, t) ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title, last_active = NOW()""", ids, [chats[c] for c in ids])
+                self.chat_writes += len(ids)
+                chats = {}
+            if members:
+                await save_memberships(self.pool, [(c, u, 'member') for c, u in members])
+                now = time.monotonic()
+                self.member_written.update((k, now) for k in members)
+                self.member_writes += len(members)
+            self.flushes += 1
+        except Exception as e:
+            # Вернём несброшенное: более свежие отметки (и названия групп) не перетираем
+            for c, t in chats.items(): self.chats.setdefault(c, t)
+            self.members |= members
+            logging.error(f"Group activity flush failed: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(GROUP_ACTIVITY_FLUSH_SECONDS)
+            await self.flush()
+            if len(self.member_written) > 100000:
+                cutoff = time.monotonic() - MEMBERSHIP_TTL.total_seconds() / 4
+                self.member_written = {k: t for k, t in self.member_written.items() if t > cutoff}
+
+    def stats(self):
+        return {"pending_chats": len(self.chats), "pending_members": len(self.members), "touches": self.touches, "flushes": self.flushes, "chat_writes": self.chat_writes, "member_writes": self.member_writes}
+
+class Maintenance:
+    # Периодическая уборка горячих таблиц. Запускается на каждой реплике: шаги идемпотентны, игры берутся
+    # с SKIP LOCKED, так что параллельный запуск лишь дублирует работу, но ничего не ломает.
+    def __init__(self, bot_instance, pool):
+        self.bot, self.pool = bot_instance, pool
+        self.removed = {}
+        self.runs = 0
+        self.last_run_at, self.last_duration = None, 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _loop(self):
+        await asyncio.sleep(random.uniform(30, 90))  # чтобы реплики не начинали уборку одновременно
+        while True:
+            await self.run_once()
+            await asyncio.sleep(MAINTENANCE_INTERVAL * random.uniform(0.9, 1.1))
+
+    async def run_once(self):
+        t0 = time.perf_counter()
+        steps = (('chat_members', self.prune_chat_members), ('idle_chats', self.prune_idle_chats), ('left_chats', self.prune_left_chats), ('santa_games', self.archive_santa_games), ('santa_jobs', self.prune_santa_jobs))
+        for name, step in steps:
+            try:
+                n = await step()
+                if n:
+                    self.removed[name] = self.removed.get(name, 0) + n
+                    logging.info(f"🧹 Maintenance {name}: {n}")
+            except Exception as e: logging.error(f"Maintenance step {name} failed: {e}")
+        self.runs += 1
+        self.last_run_at, self.last_duration = datetime.now(), time.perf_counter() - t0
+
+    async def _delete_batched(self, sql, *args):
+        # sql удаляет не больше последнего аргумента строк; повторяем, пока пачки полные
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                n = int((await conn.execute(sql, *args, MAINTENANCE_BATCH)).split()[-1])
+            total += n
+            if n < MAINTENANCE_BATCH: return total
+
+    async def prune_chat_members(self):
+        # Несвежая "состоит" ещё полезна (её get_common_chats перепроверяет первой), удаляем только то, что старше обоих TTL
+        return await self._delete_batched("DELETE FROM public.chat_members WHERE (chat_id, user_id) IN (SELECT chat_id, user_id FROM public.chat_members WHERE updated_at < NOW() - $1::INTERVAL LIMIT $2)", max(MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL))
+
+    async def prune_idle_chats(self):
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch("SELECT chat_id FROM public.known_group_chats WHERE last_active < NOW() - $1::INTERVAL ORDER BY last_active LIMIT $2", GROUP_IDLE_TTL, MAINTENANCE_BATCH)
+            # Группа могла ожить, а отметка ещё не сброшена из ActivityTracker
+            ids = [r['chat_id'] for r in rows if r['chat_id'] not in self.bot.activity.chats]
+            await forget_group_chats(self.pool, ids)
+            total += len(ids)
+            if len(rows) < MAINTENANCE_BATCH or not ids: return total
+
+    async def prune_left_chats(self):
+        # Уход бота мог пройти мимо нас (простой, потерянный апдейт): затихшие группы проверяем живьём
+        async with self.pool.acquire() as conn:
+            ids = [r['chat_id'] for r in await conn.fetch("SELECT chat_id FROM public.known_group_chats WHERE last_active < NOW() - $1::INTERVAL AND (verified_at IS NULL OR verified_at < NOW() - $1::INTERVAL) ORDER BY last_active LIMIT $2", GROUP_VERIFY_AFTER, GROUP_VERIFY_BATCH)]
+        sem = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+        async def present(chat_id):
+            async with sem:
+                try: return chat_id, member_status(await self.bot.get_chat_member(chat_id, self.bot.id)) not in ('left', 'kicked')
+                except (TelegramBadRequest, TelegramForbiddenError): return chat_id, False
+                except Exception as e:
+                    logging.warning(f"Bot presence check in {chat_id} failed: {e}")
+                    return chat_id, None
+        results = await asyncio.gather(*(present(c) for c in ids))
+        alive = [c for c, ok in results if ok]
+        if alive:
+            async with self.pool.acquire() as conn:
+                await conn.execute("UPDATE public.known_group_chats SET verified_at = NOW() WHERE chat_id = ANY($1::BIGINT[])", alive)
+        gone = [c for c, ok in results if ok is False]
+        await forget_group_chats(self.pool, gone)
+        return len(gone)
+
+    async def archive_santa_games(self):
+        # Участники разыгранных давно и брошенных в наборе игр переезжают в santa_participants_archive,
+        # сама игра остаётся (archived/expired) — по ней организатору подбираются пары в следующей игре
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    ids = [r['id'] for r in await conn.fetch("""SELECT id FROM public.santa_games WHERE (status = 'active' AND COALESCE(started_at, created_at) < NOW() - $1::INTERVAL) OR (status = 'recruiting' AND created_at < NOW() - $2::INTERVAL) ORDER BY id LIMIT $3 FOR UPDATE SKIP LOCKED""", SANTA_ARCHIVE_AFTER, SANTA_RECRUITING_TTL, MAINTENANCE_BATCH)]
+                    if ids:
+                        await conn.execute("INSERT INTO public.santa_participants_archive (game_id, user_id, wishlist, target_user_id) SELECT game_id, user_id, wishlist, target_user_id FROM public.santa_participants WHERE game_id = ANY($1::INT[]) ON CONFLICT (game_id, user_id) DO NOTHING", ids)
+                        await conn.execute("DELETE FROM public.santa_participants WHERE game_id = ANY($1::INT[])", ids)
+                        await conn.execute("DELETE FROM public.santa_exclusions WHERE game_id = ANY($1::INT[])", ids)
+                        await conn.execute("UPDATE public.santa_games SET status = CASE WHEN status = 'active' THEN 'archived' ELSE 'expired' END WHERE id = ANY($1::INT[])", ids)
+            total += len(ids)
+            if len(ids) < MAINTENANCE_BATCH: return total
+
+    async def prune_santa_jobs(self):
+        return await self._delete_batched("DELETE FROM public.santa_jobs WHERE id IN (SELECT id FROM public.santa_jobs WHERE status IN ('done', 'failed') AND updated_at < NOW() - $1::INTERVAL LIMIT $2)", SANTA_ARCHIVE_AFTER)
+
+    def stats(self):
+        return {"runs": self.runs, "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None, "last_duration_s": round(self.last_duration, 3), "removed": self.removed}
+
 # ==========================================
 # 🧠 БИЗНЕС-ЛОГИКА (ВСЕ ФУНКЦИИ ВЕРНУЛ)
 # ==========================================
+def member_status(member):
+    return getattr(member.status, 'value', member.status)
+
+async def save_memberships(pool, rows):
+    # rows: [(chat_id, user_id, status)] — одна пачка, дубли схлопываем (ON CONFLICT не любит повторы)
+    uniq = {(int(c), int(u)): st for c, u, st in rows}
+    if not uniq: return
+    keys = list(uniq)
+    async with pool.acquire() as conn:
+        await conn.execute("""INSERT INTO public.chat_members (chat_id, user_id, status, updated_at) SELECT c, u, s, NOW() FROM UNNEST($1::BIGINT[], $2::BIGINT[], $3::TEXT[]) AS t(c, u, s) ON CONFLICT (chat_id, user_id) DO UPDATE SET status = EXCLUDED.status, updated_at = NOW()""", [k[0] for k in keys], [k[1] for k in keys], [uniq[k] for k in keys])
+
+async def forget_group_chats(pool, chat_ids):
+    chat_ids = [int(c) for c in chat_ids]
+    if not chat_ids: return
+    if hasattr(bot, 'activity'): bot.activity.forget(chat_ids)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("DELETE FROM public.chat_members WHERE chat_id = ANY($1::BIGINT[])", chat_ids)
+            await conn.execute("DELETE FROM public.known_group_chats WHERE chat_id = ANY($1::BIGINT[])", chat_ids)
+
+async def check_memberships_live(bot_instance, chat_ids, user_id):
+    # Живая проверка пачкой, но не больше MEMBERSHIP_CHECK_CONCURRENCY запросов к Telegram одновременно
+    sem = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+    async def check(chat_id):
+        async with sem:
+            try: return chat_id, member_status(await bot_instance.get_chat_member(chat_id, user_id))
+            except (TelegramBadRequest, TelegramForbiddenError): return chat_id, 'left'
+            except Exception as e:
+                logging.warning(f"get_chat_member {chat_id}/{user_id} failed: {e}")
+                return chat_id, None
+    return await asyncio.gather(*(check(c) for c in chat_ids))
+
 async def get_common_chats(pool, bot_instance, user_id):
+    # Отвечаем из индекса. Живьём (не больше MEMBERSHIP_COLD_CHECK_LIMIT за запрос) перепроверяем сначала несвежие
+    # "состоит", потом группы без записи — самые активные первыми; остальные дойдут в следующие открытия приложения.
+    # Несвежая "состоит", до которой не дошла очередь, показывается как есть.
+    u_id = int(user_id)
     async with pool.acquire() as conn:
-        records = await conn.fetch("SELECT chat_id, title FROM public.known_group_chats")
-    valid_chats = []
-    for r in records:
-        try:
-            m = await bot_instance.get_chat_member(r['chat_id'], user_id)
-            if m.status not in ['left', 'kicked', 'restricted']:
-                valid_chats.append({"chat_id": str(r['chat_id']), "title": r['title']})
-        except: continue
-    return valid_chats
+        records = await conn.fetch_named('common_chats', u_id, MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL, list(INACTIVE_MEMBER_STATUSES))
+    titles = {r['chat_id']: r['title'] for r in records}
+    active = [r['chat_id'] for r in records if r['fresh'] and r['status'] not in INACTIVE_MEMBER_STATUSES]
+    stale = [r['chat_id'] for r in records if not r['fresh'] and r['status'] is not None and r['status'] not in INACTIVE_MEMBER_STATUSES]
+    unknown = [r['chat_id'] for r in records if not r['fresh'] and (r['status'] is None or r['status'] in INACTIVE_MEMBER_STATUSES)]
+    to_check = (stale + unknown)[:max(0, MEMBERSHIP_COLD_CHECK_LIMIT)]
+    checked = [(c, st) for c, st in await check_memberships_live(bot_instance, to_check, u_id) if st is not None] if to_check else []
+    if checked: await save_memberships(pool, [(c, u_id, st) for c, st in checked])
+    verified = {c for c, _ in checked}
+    active += [c for c, st in checked if st not in INACTIVE_MEMBER_STATUSES] + [c for c in stale if c not in verified]
+    return [{"chat_id": str(c), "title": titles[c]} for c in active]
 
 async def create_collection(pool, creator_id, target_chat_id, goal, amount):
     default_img = "https://cdn-icons-png.flaticon.com/512/9466/9466245.png"
@@ -148,26 +1288,51 @@ async def create_collection(pool, creator_id, target_chat_id, goal, amount):
 async def update_collection_details(pool, coll_id, user_id, desc, img):
     async with pool.acquire() as conn:
         res = await conn.execute("""UPDATE public.collections SET description = $1, image_url = $2 WHERE id = $3 AND creator_id = $4""", desc, img, int(str(coll_id).strip()), int(str(user_id).strip()))
+    invalidate_collection(coll_id)
     return "UPDATE 1" in res
 
 async def get_collection_by_id(pool, coll_id):
     try: c_id = int(str(coll_id).strip())
     except: return None
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM public.collections WHERE id = $1", c_id)
-    if not row: return None
-    percent = int((row['current_amount'] / row['amount']) * 100) if row['amount'] > 0 else 0
-    return {"id": str(row['id']), "creator_id": str(row['creator_id']), "goal": row['goal'], "description": row.get('description', ''), "image_url": row.get('image_url', ''), "amount": row['amount'], "current": row['current_amount'], "status": row.get('status', 'active'), "percent": percent}
+    async def load():
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow_named('collection_by_id', c_id)
+        if not row: return None
+        percent = int((row['current_amount'] / row['amount']) * 100) if row['amount'] > 0 else 0
+        return {"id": str(row['id']), "creator_id": str(row['creator_id']), "goal": row['goal'], "description": row.get('description', ''), "image_url": row.get('image_url', ''), "amount": row['amount'], "current": row['current_amount'], "status": row.get('status', 'active'), "percent": percent}
+    return await collection_cache.get_or_load(c_id, load)
+
+async def get_invoice_link(bot_instance, collection, amount):
+    async def load():
+        return await bot_instance.create_invoice_link(title="Вклад", description=collection['goal'], payload=f"collection_{collection['id']}", currency="XTR", prices=[LabeledPrice(label="Вклад", amount=amount)])
+    return await invoice_cache.get_or_load((int(collection['id']), amount), load)
 
-async def get_user_collections(pool, user_id):
-    u_id = int(str(user_id).strip())
+FIRST_PAGE_CURSOR = (datetime(9999, 12, 31), 2**31 - 1)
+
+def parse_page_cursor(cursor):
+    if not cursor: return FIRST_PAGE_CURSOR
+    created_at, _, row_id = str(cursor).rpartition('_')
+    created_at, row_id = datetime.fromisoformat(created_at), int(row_id)
+    if not 0 < row_id < 2**31: raise ValueError(f"Bad cursor id: {row_id}")
+    # created_at — TIMESTAMP без зоны: asyncpg не примет aware-datetime
+    if created_at.tzinfo: created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return created_at, row_id
+
+async def get_user_collections(pool, user_id, limit=COLLECTIONS_PAGE_SIZE, sections=('created', 'participated'), cursors=None):
+    # Страница на каждый список + курсор следующей страницы (None — дальше пусто)
+    u_id = int(str(user_id).strip()); limit = max(1, min(int(limit), COLLECTIONS_PAGE_MAX)); cursors = cursors or {}
     def format_row(r):
         percent = int((r['current_amount'] / r['amount']) * 100) if r['amount'] > 0 else 0
-        return {"id": str(r['id']), "goal": r['goal'], "amount": r['amount'], "current": r['current_amount'], "status": r.get('status', 'active'), "percent": percent}
+        return {"id": str(r['id']), "goal": r['goal'], "amount": r['amount'], "current": r['current_amount'], "status": r['status'] or 'active', "percent": percent}
+    result = {}
     async with pool.acquire() as conn:
-        created_records = await conn.fetch("SELECT * FROM public.collections WHERE creator_id = $1 ORDER BY created_at DESC", u_id)
-        participated_records = await conn.fetch("""SELECT DISTINCT c.* FROM public.collections c JOIN public.contributions cb ON c.id = cb.collection_id WHERE cb.user_id = $1 AND c.creator_id != $1 ORDER BY c.created_at DESC""", u_id)
-    return {"created": [format_row(r) for r in created_records], "participated": [format_row(r) for r in participated_records]}
+        for section in sections:
+            after_ts, after_id = parse_page_cursor(cursors.get(section))
+            rows = await conn.fetch_named(f"my_{section}", u_id, after_ts, after_id, limit + 1)
+            page = rows[:limit]
+            result[section] = [format_row(r) for r in page]
+            result[f"{section}_cursor"] = f"{page[-1]['created_at'].isoformat()}_{page[-1]['id']}" if len(rows) > limit else None
+    return result
 
 async def delete_collection_safely(pool, coll_id, user_id):
     c_id = int(str(coll_id).strip()); u_id = int(str(user_id).strip())
@@ -178,6 +1343,7 @@ async def delete_collection_safely(pool, coll_id, user_id):
         if row['current_amount'] > 0: return "Cannot delete: money collected"
         await conn.execute("DELETE FROM public.contributions WHERE collection_id = $1", c_id)
         await conn.execute("DELETE FROM public.collections WHERE id = $1", c_id)
+    invalidate_collection(c_id, invoices=True)
     return "OK"
 
 # --- ЛОГИКА ТАЙНОГО САНТЫ ---
@@ -196,88 +1362,281 @@ async def join_santa_game(pool, game_id, user_id, wishlist):
         await conn.execute("""INSERT INTO public.santa_participants (game_id, user_id, wishlist) VALUES ($1, $2, $3) ON CONFLICT (game_id, user_id) DO UPDATE SET wishlist = EXCLUDED.wishlist""", int(game_id), int(user_id), processed_wishlist)
     return "OK"
 
-async def get_user_santa_state(pool, bot_instance, user_id):
+async def resolve_display_names(bot_instance, user_ids, wait_flood=False):
+    sem = asyncio.Semaphore(NAME_LOOKUP_CONCURRENCY)
+    async def one(u):
+        async with sem: return u, await get_user_display_name(bot_instance, u, wait_flood)
+    return dict(await asyncio.gather(*(one(u) for u in user_ids)))
+
+async def get_user_santa_state(pool, bot_instance, user_id, all_games=False):
+    # Одним запросом: игры пользователя, число участников и вишлист подопечного. Имена — уже без соединения.
     u_id = int(user_id)
     async with pool.acquire() as conn:
-        rows = await conn.fetch("""SELECT p.*, g.title, g.status as game_status, g.creator_id FROM public.santa_participants p JOIN public.santa_games g ON p.game_id = g.id WHERE p.user_id = $1 AND g.status IN ('recruiting', 'active') ORDER BY g.created_at DESC""", u_id)
-        bot_username = getattr(bot_instance, 'username', 'GiftFlowBot')
-        games_list = []
-        for row in rows:
-            game_id = row['game_id']; is_creator = str(row['creator_id']) == str(user_id)
-            game_data = {"game_id": str(game_id), "game_title": row['title'] or "Тайный Санта", "game_status": row['game_status'], "is_creator": is_creator, "my_wishlist": row['wishlist'] or "", "invite_link": f"https://t.me/{bot_username}/app?startapp=santa_{game_id}" if (is_creator and row['game_status'] == 'recruiting') else None}
-            if row['game_status'] == 'recruiting':
-                participants = await conn.fetch("SELECT user_id FROM public.santa_participants WHERE game_id = $1", game_id)
-                game_data['participants_count'] = len(participants)
-            if row['game_status'] == 'active' and row['target_user_id']:
-                target_id = row['target_user_id']
-                target_row = await conn.fetchrow("SELECT wishlist FROM public.santa_participants WHERE game_id = $1 AND user_id = $2", game_id, target_id)
-                if target_row:
-                    game_data["target_user_name"] = await get_user_display_name(bot_instance, target_id)
-                    game_data["target_wishlist"] = target_row['wishlist'] or "Вишлист пуст"
-            games_list.append(game_data)
-        state_to_return = games_list[0] if games_list else None
-    return state_to_return
-
-async def start_santa_game_shuffle(pool, bot_instance: Bot, game_id, creator_id):
-    pairs_to_notify = []; g_id = int(game_id); c_id = int(creator_id)
+        rows = await conn.fetch_named('santa_state', u_id, SANTA_STATE_MAX_GAMES if all_games else 1)
+    bot_username = getattr(bot_instance, 'username', 'GiftFlowBot')
+    names = await resolve_display_names(bot_instance, {r['target_id'] for r in rows if r['game_status'] == 'active' and r['target_id']})
+    games_list = []
+    for row in rows:
+        game_id = row['game_id']; is_creator = str(row['creator_id']) == str(user_id)
+        game_data = {"game_id": str(game_id), "game_title": row['title'] or "Тайный Санта", "game_status": row['game_status'], "is_creator": is_creator, "my_wishlist": row['wishlist'] or "", "participants_count": row['participants_count'], "invite_link": f"https://t.me/{bot_username}/app?startapp=santa_{game_id}" if (is_creator and row['game_status'] == 'recruiting') else None}
+        if row['game_status'] == 'active' and row['target_id']:
+            game_data["target_user_name"] = names[row['target_id']]
+            game_data["target_wishlist"] = row['target_wishlist'] or "Вишлист пуст"
+        games_list.append(game_data)
+    if all_games: return games_list
+    return games_list[0] if games_list else None
+
+def _santa_augment(start, order, allowed, match_g, match_r, free_r):
+    # Поиск чередующегося пути (Кун): даритель -> разрешённый получатель -> его текущий даритель -> ...
+    # пока не упрёмся в даритель, которому подходит свободный получатель. Каждый получатель посещается один раз.
+    def free_for(g): return next((r for r in free_r if allowed(g, r)), None)
+    parent, seen = {}, set()
+    stack = [(start, iter(order))]
+    last, end = start, free_for(start)
+    while end is None and stack:
+        g, it = stack[-1]
+        r = next((r for r in it if r not in seen and r in match_r and allowed(g, r)), None)
+        if r is None:
+            stack.pop()
+            continue
+        seen.add(r); parent[r] = g
+        last = match_r[r]
+        end = free_for(last)
+        if end is None: stack.append((last, iter(order)))
+    if end is None: return False
+    free_r.remove(end)
+    g, r = last, end
+    while True:
+        prev_r = match_g.get(g)
+        match_g[g] = r; match_r[r] = g
+        if g == start: return True
+        g, r = parent[prev_r], prev_r
+
+def santa_draw(user_ids, exclusions=(), seed=None):
+    # Возвращает {даритель: получатель} без подарков самому себе и без запрещённых пар, либо None, если так нельзя.
+    # Обычно хватает случайного единого цикла (перемешать и замкнуть по кругу — O(n), всегда деранжемент).
+    # Если исключения мешают, берём лучший цикл, выкидываем плохие пары и достраиваем паросочетание.
+    rng = random.Random(seed)
+    ids = sorted({int(u) for u in user_ids})
+    if len(ids) < 2: return None
+    forbidden = {(int(g), int(r)) for g, r in exclusions}
+    def allowed(g, r): return g != r and (g, r) not in forbidden
+    best = None
+    for _ in range(max(1, SANTA_CYCLE_ATTEMPTS)):
+        order = ids[:]; rng.shuffle(order)
+        pairs = {order[i - 1]: order[i] for i in range(len(order))}
+        bad = [g for g, r in pairs.items() if not allowed(g, r)]
+        if not bad: return pairs
+        if best is None or len(bad) < len(best[1]): best = (pairs, bad)
+        if not forbidden: break
+    pairs, bad = best
+    match_g = {g: r for g, r in pairs.items() if allowed(g, r)}
+    match_r = {r: g for g, r in match_g.items()}
+    free_r = [r for r in ids if r not in match_r]
+    order = ids[:]; rng.shuffle(order)
+    for g in bad:
+        if not _santa_augment(g, order, allowed, match_g, match_r, free_r): return None
+    return match_g
+
+async def add_santa_exclusion(pool, game_id, creator_id, user_a, user_b, mutual=True):
+    g_id = int(game_id); a = int(user_a); b = int(user_b)
+    pairs = [(a, b), (b, a)] if mutual else [(a, b)]
+    async with pool.acquire() as conn:
+        game = await conn.fetchrow("SELECT creator_id, status FROM public.santa_games WHERE id = $1", g_id)
+        if not game or game['status'] != 'recruiting': return "Игра не в статусе набора"
+        if str(game['creator_id']) != str(creator_id): return "Нет прав"
+        await conn.executemany("INSERT INTO public.santa_exclusions (game_id, giver_id, receiver_id) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING", [(g_id, g, r) for g, r in pairs])
+    return "OK"
+
+async def start_santa_game_shuffle(pool, bot_instance: Bot, game_id, creator_id, seed=None, job_id=None):
+    g_id = int(game_id); c_id = int(creator_id)
+    # Имена получателей собираем заранее, чтобы уведомления легли в outbox в той же транзакции, что и жеребьевка
+    async with pool.acquire() as conn:
+        known = [r['user_id'] for r in await conn.fetch("SELECT user_id FROM public.santa_participants WHERE game_id = $1", g_id)]
+    names = await resolve_display_names(bot_instance, known, wait_flood=True)
     async with pool.acquire() as conn:
         async with conn.transaction():
-            game = await conn.fetchrow("SELECT creator_id, status, title FROM public.santa_games WHERE id = $1", g_id)
+            game = await conn.fetchrow("SELECT creator_id, status, title FROM public.santa_games WHERE id = $1 FOR UPDATE", g_id)
             if not game or game['status'] != 'recruiting': return "Игра не в статусе набора"
             if str(game['creator_id']) != str(c_id): return "Нет прав"
             participants = await conn.fetch("SELECT user_id FROM public.santa_participants WHERE game_id = $1", g_id)
             if len(participants) < 2: return "Слишком мало участников"
             user_ids = [p['user_id'] for p in participants]
-            givers = user_ids[:]; receivers = user_ids[:]
-            attempts = 0
-            while attempts < 20:
-                random.shuffle(receivers)
-                if not any(g == r for g, r in zip(givers, receivers)): break
-                attempts += 1
-            if any(g == r for g, r in zip(givers, receivers)): return "Ошибка жеребьевки"
-            for giver_id, receiver_id in zip(givers, receivers):
-                await conn.execute("UPDATE public.santa_participants SET target_user_id = $1 WHERE game_id = $2 AND user_id = $3", receiver_id, g_id, giver_id)
-                pairs_to_notify.append((giver_id, receiver_id))
-            await conn.execute("UPDATE public.santa_games SET status = 'active' WHERE id = $1", g_id)
-    
-    game_title = game['title'] or "Тайный Санта"
-    for giver_id, receiver_id in pairs_to_notify:
-        try:
-            receiver_name = await get_user_display_name(bot_instance, receiver_id)
-            await bot_instance.send_message(giver_id, f"🎅 <b>Жеребьевка в игре «{html.escape(game_title)}» завершена!</b>\n\nТвой подопечный: <b>{receiver_name}</b> 🎁\n\nЗайди в приложение, чтобы увидеть его вишлист!")
-            await asyncio.sleep(0.05)
-        except: pass
+            excluded = [(r['giver_id'], r['receiver_id']) for r in await conn.fetch("SELECT giver_id, receiver_id FROM public.santa_exclusions WHERE game_id = $1", g_id)]
+            # Мягкое ограничение: не повторяем пары из прошлой игры этого организатора, если это вообще возможно
+            # (прошлая игра могла уже уехать в архив — пары тогда берём из santa_participants_archive)
+            previous = [(r['user_id'], r['target_user_id']) for r in await conn.fetch("""WITH prev AS (SELECT id FROM public.santa_games WHERE creator_id = $1 AND id <> $2 AND status IN ('active', 'archived') ORDER BY created_at DESC LIMIT 1)
+                SELECT user_id, target_user_id FROM public.santa_participants WHERE target_user_id IS NOT NULL AND game_id = (SELECT id FROM prev)
+                UNION ALL SELECT user_id, target_user_id FROM public.santa_participants_archive WHERE target_user_id IS NOT NULL AND game_id = (SELECT id FROM prev)""", c_id, g_id)]
+            pairs = (santa_draw(user_ids, excluded + previous, seed) if previous else None) or santa_draw(user_ids, excluded, seed)
+            if not pairs: return "Ошибка жеребьевки"
+            givers = list(pairs)
+            await conn.execute("""UPDATE public.santa_participants p SET target_user_id = a.receiver FROM UNNEST($2::BIGINT[], $3::BIGINT[]) AS a(giver, receiver) WHERE p.game_id = $1 AND p.user_id = a.giver""", g_id, givers, [pairs[g] for g in givers])
+            await conn.execute("UPDATE public.santa_games SET status = 'active', started_at = NOW() WHERE id = $1", g_id)
+            game_title = html.escape(game['title'] or "Тайный Санта")
+            outbox = await NotificationQueue.persist(conn, [(g, f"🎅 <b>Жеребьевка в игре «{game_title}» завершена!</b>\n\nТвой подопечный: <b>{html.escape(names.get(r) or name_cache.peek(r) or f'Участник (ID: {r})')}</b> 🎁\n\nЗайди в приложение, чтобы увидеть его вишлист!", None) for g, r in pairs.items()], job_id)
+            if job_id: await conn.execute("UPDATE public.santa_jobs SET status = 'notifying', total = $2, updated_at = NOW() WHERE id = $1", job_id, len(outbox))
+    bot_instance.notifier.dispatch(outbox)
     return "OK"
 
+class SantaJobs:
+    # /api/santa/start только ставит задание в santa_jobs и сразу отдаёт job_id; имена, розыгрыш и outbox — в фоне.
+    # queued/drawing держатся арендой lease_until: если процесс упал, по истечении аренды задание подхватит любой
+    # экземпляр. Розыгрыш и перевод в notifying коммитятся вместе, прогресс — сколько строк задания осталось в outbox
+    # (выброшенные без доставки считаются в santa_jobs.failed, а не в отправленных).
+    def __init__(self, bot_instance, pool):
+        self.bot, self.pool = bot_instance, pool
+        self.running = {}
+        self.submitted = self.drawn = self.failed = self.resumed = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._resume_loop())
+
+    async def stop(self):
+        # id запоминаем до отмены: done-колбэк из _spawn убирает задачу из running, как только она завершится
+        job_ids = list(self.running)
+        tasks = ([self._task] if self._task else []) + list(self.running.values())
+        for t in tasks: t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if job_ids:
+            # Отдаём аренду сразу, чтобы после деплоя задание не ждало её истечения
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute("UPDATE public.santa_jobs SET lease_until = NOW() WHERE id = ANY($1::BIGINT[]) AND status IN ('queued', 'drawing')", job_ids)
+            except Exception as e: logging.warning(f"Santa job lease release failed: {e}")
+
+    def _spawn(self, job_id):
+        task = self.running[job_id] = asyncio.create_task(self._run(job_id))
+        task.add_done_callback(lambda t: self.running.pop(job_id, None) if self.running.get(job_id) is t else None)
+
+    async def submit(self, game_id, creator_id):
+        # Быстрые проверки — сразу, чтобы организатор увидел ошибку; повторное нажатие вернёт то же задание
+        g_id, c_id = int(game_id), int(creator_id)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                game = await conn.fetchrow("SELECT creator_id, status FROM public.santa_games WHERE id = $1 FOR UPDATE", g_id)
+                if not game or game['status'] != 'recruiting': return None, "Игра не в статусе набора"
+                if game['creator_id'] != c_id: return None, "Нет прав"
+                job_id = await conn.fetchval("SELECT id FROM public.santa_jobs WHERE game_id = $1 AND status IN ('queued', 'drawing') ORDER BY id DESC LIMIT 1", g_id)
+                if job_id: return job_id, None
+                if await conn.fetchval("SELECT COUNT(*) FROM public.santa_participants WHERE game_id = $1", g_id) < 2: return None, "Слишком мало участников"
+                job_id = await conn.fetchval("INSERT INTO public.santa_jobs (game_id, creator_id, lease_until) VALUES ($1, $2, NOW() + $3::INTERVAL) RETURNING id", g_id, c_id, SANTA_JOB_LEASE)
+        self.submitted += 1
+        self._spawn(job_id)
+        return job_id, None
+
+    async def _fail(self, job_id, error):
+        # Только из queued/drawing: если розыгрыш уже закоммитил другой экземпляр (notifying/done),
+        # его "Игра не в статусе набора" не должна превратить удачную жеребьевку в проваленную
+        async with self.pool.acquire() as conn:
+            res = await conn.execute("UPDATE public.santa_jobs SET status = 'failed', error = $2, updated_at = NOW() WHERE id = $1 AND status IN ('queued', 'drawing')", job_id, str(error))
+        if res.endswith(" 0"): return
+        self.failed += 1
+        logging.error(f"Santa job {job_id} failed: {error}")
+
+    async def _run(self, job_id):
+        async with self.pool.acquire() as conn:
+            job = await conn.fetchrow("UPDATE public.santa_jobs SET status = 'drawing', attempts = attempts + 1, lease_until = NOW() + $2::INTERVAL, updated_at = NOW() WHERE id = $1 AND status IN ('queued', 'drawing') RETURNING game_id, creator_id, attempts", job_id, SANTA_JOB_LEASE)
+        if not job: return
+        if job['attempts'] > SANTA_JOB_MAX_ATTEMPTS: return await self._fail(job_id, "Превышено число попыток")
+        try: result = await start_santa_game_shuffle(self.pool, self.bot, job['game_id'], job['creator_id'], job_id=job_id)
+        except asyncio.CancelledError: raise
+        except Exception as e:
+            if job['attempts'] >= SANTA_JOB_MAX_ATTEMPTS: return await self._fail(job_id, e)
+            # Повтор подберёт _resume_loop, когда истечёт короткая аренда
+            logging.error(f"Santa job {job_id} attempt {job['attempts']} failed: {e}")
+            async with self.pool.acquire() as conn:
+                await conn.execute("UPDATE public.santa_jobs SET lease_until = NOW() + $2::INTERVAL, error = $3, updated_at = NOW() WHERE id = $1", job_id, timedelta(seconds=10 * job['attempts']), str(e))
+            return
+        if result != "OK": return await self._fail(job_id, result)
+        self.drawn += 1
+
+    async def _resume_loop(self):
+        while True:
+            try:
+                async with self.pool.acquire() as conn:
+                    if self.running:
+                        await conn.execute("UPDATE public.santa_jobs SET lease_until = NOW() + $2::INTERVAL WHERE id = ANY($1::BIGINT[]) AND status IN ('queued', 'drawing')", list(self.running), SANTA_JOB_LEASE)
+                    rows = await conn.fetch("""UPDATE public.santa_jobs SET lease_until = NOW() + $1::INTERVAL WHERE id IN (SELECT id FROM public.santa_jobs WHERE status IN ('queued', 'drawing') AND lease_until <= NOW() ORDER BY id LIMIT 20 FOR UPDATE SKIP LOCKED) RETURNING id""", SANTA_JOB_LEASE)
+                    await conn.execute("UPDATE public.santa_jobs j SET status = 'done', updated_at = NOW() WHERE status = 'notifying' AND NOT EXISTS (SELECT 1 FROM public.notification_outbox o WHERE o.job_id = j.id)")
+                for r in rows:
+                    if r['id'] not in self.running:
+                        self.resumed += 1
+                        logging.info(f"🎲 Resuming santa job {r['id']}")
+                        self._spawn(r['id'])
+            except Exception as e: logging.error(f"Santa job recovery error: {e}")
+            await asyncio.sleep(SANTA_JOB_POLL_INTERVAL)
+
+    async def status(self, user_id, job_id=None, game_id=None):
+        async with self.pool.acquire() as conn:
+            if job_id: job = await conn.fetchrow("SELECT id, game_id, creator_id, status, total, failed, error FROM public.santa_jobs WHERE id = $1", int(job_id))
+            else: job = await conn.fetchrow("SELECT id, game_id, creator_id, status, total, failed, error FROM public.santa_jobs WHERE game_id = $1 ORDER BY id DESC LIMIT 1", int(game_id))
+            if not job or job['creator_id'] != int(user_id): return None
+            pending = await conn.fetchval("SELECT COUNT(*) FROM public.notification_outbox WHERE job_id = $1", job['id']) if job['status'] == 'notifying' else 0
+        state = 'done' if job['status'] == 'notifying' and not pending else job['status']
+        return {"job_id": str(job['id']), "game_id": str(job['game_id']), "state": state, "total": job['total'], "sent": job['total'] - pending - job['failed'], "failed": job['failed'], "error": job['error'] if state == 'failed' else None}
+
+    def stats(self):
+        return {"running": len(self.running), "submitted": self.submitted, "drawn": self.drawn, "failed": self.failed, "resumed": self.resumed}
+
 # ==========================================
 # 🤖 AIOGRAM ХЕНДЛЕРЫ
 # ==========================================
+# Telegram повторяет вебхук, если не дождался ответа (повтор может прийти и на другую реплику). Хендлеры идемпотентны:
+# платёж — по charge_id, активность и членство — upsert, поэтому журнал апдейтов в БД не нужен, а запись на каждое
+# сообщение в группе была бы дороже самой обработки. LRU на реплику гасит повторы, дошедшие до неё же.
+# update_id запоминаем только после успешной обработки — повтор упавшего апдейта должен отработать.
+recent_updates = OrderedDict()
+
+@dp.update.outer_middleware()
+async def dedup_updates(handler, event: types.Update, data):
+    if BOT_MODE != 'webhook': return await handler(event, data)
+    if event.update_id in recent_updates:
+        logging.info(f"Duplicate update {event.update_id} skipped")
+        return
+    result = await handler(event, data)
+    recent_updates[event.update_id] = None
+    if len(recent_updates) > UPDATE_DEDUP_SIZE: recent_updates.popitem(last=False)
+    return result
+
 @dp.pre_checkout_query()
 async def process_pre_checkout_query(q: PreCheckoutQuery): await bot.answer_pre_checkout_query(q.id, ok=True)
 
 @dp.message(F.successful_payment)
 async def process_successful_payment(msg: types.Message):
     pmnt = msg.successful_payment
-    try:
-        prefix, c_id_str = pmnt.invoice_payload.split('_'); collection_id = int(c_id_str)
-        if prefix != 'collection': return
-        async with bot.db_pool.acquire() as conn:
-            async with conn.transaction():
-                await conn.execute("INSERT INTO public.contributions (collection_id, user_id, amount, currency, telegram_payment_charge_id) VALUES ($1, $2, $3, $4, $5)", collection_id, msg.from_user.id, pmnt.total_amount, pmnt.currency, pmnt.telegram_payment_charge_id)
-                res = await conn.fetchrow("UPDATE public.collections SET current_amount = current_amount + $1 WHERE id = $2 RETURNING current_amount, amount, goal, target_chat_id, status", pmnt.total_amount, collection_id)
-                if res['current_amount'] >= res['amount'] and res['status'] == 'active':
-                    await conn.execute("UPDATE public.collections SET status = 'finished' WHERE id = $1", collection_id)
-                    try: await bot.send_message(res['target_chat_id'], f"🎉 <b>СБОР ЗАВЕРШЕН!</b>\nЦель «{html.escape(res['goal'])}» достигнута! Собрано {res['current_amount']} ⭐", parse_mode="HTML")
-                    except: pass
-    except: pass
+    try: prefix, c_id_str = pmnt.invoice_payload.split('_'); collection_id = int(c_id_str)
+    except ValueError:
+        logging.error(f"Unknown invoice payload: {pmnt.invoice_payload} ({pmnt.telegram_payment_charge_id})")
+        return
+    if prefix != 'collection': return
+    # Если платёж не лёг в pending_payments, исключение уходит наружу: вебхук ответит 500 и Telegram повторит апдейт
+    await bot.contributions.submit(collection_id, msg.from_user.id, pmnt.total_amount, pmnt.currency, pmnt.telegram_payment_charge_id)
 
 @dp.message(F.chat.type.in_({"group", "supergroup"}))
 async def track_group_activity(msg: types.Message):
-    if msg.chat and msg.chat.id and msg.chat.title and hasattr(bot, 'db_pool'):
-        try:
-            async with bot.db_pool.acquire() as conn:
-                await conn.execute("""INSERT INTO public.known_group_chats (chat_id, title, last_active) VALUES ($1, $2, NOW()) ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title, last_active = NOW()""", msg.chat.id, msg.chat.title)
-        except: pass
+    if msg.chat and msg.chat.id and msg.chat.title and hasattr(bot, 'activity'):
+        bot.activity.touch(msg.chat.id, msg.chat.title, msg.from_user.id if msg.from_user and not msg.from_user.is_bot else None)
+
+@dp.chat_member(F.chat.type.in_({"group", "supergroup"}))
+async def track_chat_member(event: types.ChatMemberUpdated):
+    if not hasattr(bot, 'db_pool'): return
+    try: await save_memberships(bot.db_pool, [(event.chat.id, event.new_chat_member.user.id, member_status(event.new_chat_member))])
+    except Exception as e: logging.warning(f"chat_member update failed: {e}")
+
+@dp.my_chat_member(F.chat.type.in_({"group", "supergroup"}))
+async def track_bot_membership(event: types.ChatMemberUpdated):
+    if not hasattr(bot, 'db_pool'): return
+    try:
+        if member_status(event.new_chat_member) in ('left', 'kicked'):
+            await forget_group_chats(bot.db_pool, [event.chat.id])
+            return
+        async with bot.db_pool.acquire() as conn:
+            await conn.execute("""INSERT INTO public.known_group_chats (chat_id, title, last_active) VALUES ($1, $2, NOW()) ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title, last_active = NOW()""", event.chat.id, event.chat.title)
+        if event.from_user and not event.from_user.is_bot:
+            await save_memberships(bot.db_pool, [(event.chat.id, event.from_user.id, 'member')])
+    except Exception as e: logging.warning(f"my_chat_member update failed: {e}")
 
 # ==========================================
 # 🌐 ВЕБ-СЕРВЕР (API)
@@ -288,15 +1647,71 @@ def api_handler_wrapper(handler):
         try:
             return await handler(request)
         except Exception as e:
-            logging.error(f"API Error: {e}")
+            logging.error(f"API Error {request.path}: {e}")
             return web.json_response({"status": "error", "error": str(e)}, status=500, headers=CORS_HEADERS)
     return wrapped
 
 async def handle_options(request): return web.Response(headers=CORS_HEADERS)
 
 async def parse_body(request):
-    data = await request.json()
-    return data, data.get('chat_id')
+    # Тело уже разобрано в api_guard; пользователь — из проверенного initData, а не из chat_id в теле
+    data = request.get('body')
+    if data is None: data = await request.json()
+    uid = request.get('user_id')
+    if uid is None and not WEBAPP_AUTH_REQUIRED: uid = data.get('chat_id')
+    return data, uid
+
+# --- ЗАЩИТА API ---
+# initData не меняется, пока Mini App открыт, поэтому подпись проверяется один раз на сессию, дальше — из кэша
+webapp_auth_cache = AsyncTTLCache(20000, WEBAPP_AUTH_CACHE_TTL)
+api_buckets = {}
+
+async def webapp_user_id(init_data):
+    async def load():
+        parsed = safe_parse_webapp_init_data(BOT_TOKEN, init_data)
+        return (parsed.user.id if parsed.user else None), parsed.auth_date.timestamp()
+    try: user_id, auth_date = await webapp_auth_cache.get_or_load(init_data, load)
+    except ValueError: return None
+    if WEBAPP_AUTH_MAX_AGE and time.time() - auth_date > WEBAPP_AUTH_MAX_AGE: return None
+    return user_id
+
+def api_bucket(key, route):
+    bucket = api_buckets.get((key, route))
+    if bucket is None:
+        if len(api_buckets) > 100000:
+            for k in [k for k, b in api_buckets.items() if b.idle()]: del api_buckets[k]
+        rate, burst = API_ROUTE_LIMITS[route] if route else (API_USER_RATE, API_USER_BURST)
+        bucket = api_buckets[(key, route)] = TokenBucket(rate, burst)
+    return bucket
+
+def api_reject(reason, status, message, headers=None):
+    metrics.inc('giftflow_api_rejected_total', (('reason', reason),))
+    return web.json_response({"status": "error", "error": message}, status=status, headers={**CORS_HEADERS, **(headers or {})})
+
+@web.middleware
+async def api_guard(request, handler):
+    # Дешёвые проверки до хендлера: размер тела, подпись initData, лимиты. Отбитый запрос не трогает ни БД, ни Bot API
+    resource = request.match_info.route.resource
+    if request.method != 'POST' or resource is None or not resource.canonical.startswith('/api/'): return await handler(request)
+    route = resource.canonical
+    if route != '/api/upload':  # у загрузки свой потолок, тело читается потоком
+        if request.content_length is None: return api_reject('length_required', 411, "Content-Length required")
+        if request.content_length > API_MAX_BODY_BYTES: return api_reject('body_too_large', 413, "Request too large")
+    init_data = request.headers.get('X-Telegram-Init-Data')
+    user_id = await webapp_user_id(init_data) if init_data else None
+    if user_id is None and WEBAPP_AUTH_REQUIRED: return api_reject('unauthorized', 401, "Unauthorized")
+    key = user_id or request.remote
+    buckets = [api_bucket(key, None)] + ([api_bucket(key, route)] if route in API_ROUTE_LIMITS else [])
+    wait = max(b.wait_time() for b in buckets)
+    if wait > 0: return api_reject('rate_limited', 429, "Too many requests", {"Retry-After": str(math.ceil(wait))})
+    for b in buckets: b.take()
+    request['user_id'] = user_id
+    if route != '/api/upload':
+        try: body = await request.json()
+        except ValueError: body = None
+        if not isinstance(body, dict): return api_reject('bad_json', 400, "Invalid JSON")
+        request['body'] = body
+    return await handler(request)
 
 @api_handler_wrapper
 async def api_get_chats(request):
@@ -306,8 +1721,17 @@ async def api_get_chats(request):
 
 @api_handler_wrapper
 async def api_get_my_collections(request):
-    _, uid = await parse_body(request)
-    data = await get_user_collections(bot.db_pool, uid)
+    body, uid = await parse_body(request)
+    section = body.get('list')
+    if section not in (None, 'created', 'participated'): return web.json_response({"error": "Unknown list"}, status=400, headers=CORS_HEADERS)
+    sections = (section,) if section else ('created', 'participated')
+    cursors = {section: body.get('cursor')} if section else {}
+    try:
+        limit = int(body.get('limit') or COLLECTIONS_PAGE_SIZE)
+        for c in cursors.values(): parse_page_cursor(c)
+    except (ValueError, TypeError, OverflowError):
+        return web.json_response({"error": "Bad cursor or limit"}, status=400, headers=CORS_HEADERS)
+    data = await get_user_collections(bot.db_pool, uid, limit, sections, cursors)
     return web.json_response({"status": "ok", "data": data}, headers=CORS_HEADERS)
 
 @api_handler_wrapper
@@ -328,10 +1752,9 @@ async def api_create_collection(request):
     cid = await create_collection(bot.db_pool, uid, data.get('target_chat_id'), data.get('goal'), int(data.get('amount', 0)))
     if cid:
         try:
-            me = await bot.get_me()
-            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💸 Внести вклад", url=f"https://t.me/{me.username}/app?startapp=donate_{cid}")]])
-            await bot.send_message(data.get('target_chat_id'), f"🚀 <b>НОВЫЙ СБОР</b>\nЦель: {html.escape(data.get('goal'))}\nНужно: {int(data.get('amount', 0)):,} ⭐", reply_markup=kb, parse_mode="HTML")
-        except: pass
+            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💸 Внести вклад", url=f"https://t.me/{bot.username}/app?startapp=donate_{cid}")]])
+            await bot.notifier.enqueue(data.get('target_chat_id'), f"🚀 <b>НОВЫЙ СБОР</b>\nЦель: {html.escape(data.get('goal'))}\nНужно: {int(data.get('amount', 0)):,} ⭐", kb)
+        except Exception as e: logging.error(f"Collection announce failed: {e}")
         return web.json_response({"status": "ok", "collection_id": cid}, headers=CORS_HEADERS)
     return web.json_response({"error": "Failed"}, status=500, headers=CORS_HEADERS)
 
@@ -341,17 +1764,68 @@ async def api_delete_collection(request):
     res = await delete_collection_safely(bot.db_pool, data.get('collection_id'), uid)
     return web.json_response({"status": "ok"} if res == "OK" else {"error": res}, headers=CORS_HEADERS)
 
+def issue_stream_token(user_id, collection_id):
+    body = f"{user_id or ''}.{collection_id}.{int(time.time()) + SSE_TOKEN_TTL}"
+    return f"{body}.{hmac.new(SSE_TOKEN_KEY, body.encode(), hashlib.sha256).hexdigest()}"
+
+def check_stream_token(token, collection_id):
+    # Токен годится только для потока этого сбора и только SSE_TOKEN_TTL секунд; возвращает user_id или None
+    try: user_id, c_id, expires, sig = token.split('.')
+    except ValueError: return None
+    if not hmac.compare_digest(sig, hmac.new(SSE_TOKEN_KEY, f"{user_id}.{c_id}.{expires}".encode(), hashlib.sha256).hexdigest()): return None
+    if c_id != str(collection_id).strip() or not expires.isdigit() or int(expires) < time.time(): return None
+    return int(user_id) if user_id.isdigit() else None
+
+@api_handler_wrapper
+async def api_collection_stream_token(request):
+    data, uid = await parse_body(request)
+    c = await get_collection_by_id(bot.db_pool, data.get('collection_id'))
+    if not c: return web.json_response({"error": "Not found"}, status=404, headers=CORS_HEADERS)
+    return web.json_response({"status": "ok", "token": issue_stream_token(uid, c['id']), "expires_in": SSE_TOKEN_TTL}, headers=CORS_HEADERS)
+
+async def api_collection_stream(request):
+    # SSE: сразу снимок прогресса, дальше только изменения из CollectionHub. api_guard GET не трогает,
+    # пользователь — из токена потока (initData в адрес не кладём: query целиком пишется в access log)
+    user_id = check_stream_token(request.query.get('token', ''), request.query.get('collection_id', ''))
+    if user_id is None and WEBAPP_AUTH_REQUIRED: return api_reject('unauthorized', 401, "Unauthorized")
+    collection = await get_collection_by_id(bot.db_pool, request.query.get('collection_id'))
+    if not collection: return web.json_response({"status": "error", "error": "Collection not found"}, status=404, headers=CORS_HEADERS)
+    c_id, user_key = int(collection['id']), user_id or request.remote
+    queue = bot.hub.subscribe(c_id, user_key)
+    if queue is None: return api_reject('too_many_streams', 429, "Too many streams", {"Retry-After": "30"})
+    request['streaming'] = True
+    resp = web.StreamResponse(headers={**CORS_HEADERS, "Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    try:
+        await resp.prepare(request)
+        snapshot = collection_progress(c_id, collection['current'], collection['amount'], collection['status'])
+        bot.hub.last.setdefault(c_id, snapshot)
+        await resp.write(f"retry: 5000\nevent: progress\ndata: {json.dumps(snapshot)}\n\n".encode())
+        while True:
+            try: data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                await resp.write(b": ping\n\n")  # держим прокси открытыми и замечаем ушедших клиентов
+                continue
+            if data is None: break
+            await resp.write(f"event: progress\ndata: {json.dumps(data)}\n\n".encode())
+    except ConnectionResetError: pass
+    finally: bot.hub.unsubscribe(c_id, queue, user_key)
+    return resp
+
 @api_handler_wrapper
 async def api_create_invoice(request):
     data, _ = await parse_body(request)
     c = await get_collection_by_id(bot.db_pool, data.get('collection_id'))
-    inv = await bot.create_invoice_link(title="Вклад", description=c['goal'], payload=f"collection_{c['id']}", currency="XTR", prices=[LabeledPrice(label="Вклад", amount=int(data.get('amount')))])
+    if not c: return web.json_response({"error": "Not found"}, status=404, headers=CORS_HEADERS)
+    inv = await get_invoice_link(bot, c, int(data.get('amount')))
     return web.json_response({"status": "ok", "invoice_url": inv}, headers=CORS_HEADERS)
 
 # --- API САНТА (ВЕРНУЛ ОБРАТНО!) ---
 @api_handler_wrapper
 async def api_santa_get_state(request):
-    _, uid = await parse_body(request)
+    data, uid = await parse_body(request)
+    if data.get('all_games'):
+        games = await get_user_santa_state(bot.db_pool, bot, uid, all_games=True)
+        return web.json_response({"status": "ok", "state": games[0] if games else None, "games": games}, headers=CORS_HEADERS)
     state = await get_user_santa_state(bot.db_pool, bot, uid)
     return web.json_response({"status": "ok", "state": state}, headers=CORS_HEADERS)
 
@@ -370,8 +1844,22 @@ async def api_santa_join(request):
 @api_handler_wrapper
 async def api_santa_start(request):
     data, uid = await parse_body(request)
-    await start_santa_game_shuffle(bot.db_pool, bot, data.get('game_id'), uid)
-    return web.json_response({"status": "ok"}, headers=CORS_HEADERS)
+    job_id, error = await bot.santa_jobs.submit(data.get('game_id'), uid)
+    if error: return web.json_response({"status": "error", "error": error}, headers=CORS_HEADERS)
+    return web.json_response({"status": "ok", "job_id": str(job_id)}, headers=CORS_HEADERS)
+
+@api_handler_wrapper
+async def api_santa_job(request):
+    data, uid = await parse_body(request)
+    job = await bot.santa_jobs.status(uid, job_id=data.get('job_id'), game_id=data.get('game_id'))
+    if not job: return web.json_response({"status": "error", "error": "Задание не найдено"}, status=404, headers=CORS_HEADERS)
+    return web.json_response({"status": "ok", "job": job}, headers=CORS_HEADERS)
+
+@api_handler_wrapper
+async def api_santa_exclude(request):
+    data, uid = await parse_body(request)
+    res = await add_santa_exclusion(bot.db_pool, data.get('game_id'), uid, data.get('user_a'), data.get('user_b'), data.get('mutual', True))
+    return web.json_response({"status": "ok"} if res == "OK" else {"error": res}, headers=CORS_HEADERS)
 
 @api_handler_wrapper
 async def api_santa_mark_sent(request):
@@ -388,40 +1876,196 @@ async def api_santa_mark_received(request):
 async def api_santa_mark_sent_logic(bot, pool, uid, gid):
     async with pool.acquire() as conn:
         p = await conn.fetchrow("SELECT target_user_id FROM public.santa_participants WHERE game_id=$1 AND user_id=$2", gid, uid)
-        if p and p['target_user_id']:
-            try: await bot.send_message(p['target_user_id'], "🎁 Санта отправил подарок!")
-            except: pass
+    if p and p['target_user_id']:
+        await bot.notifier.enqueue(p['target_user_id'], "🎁 Санта отправил подарок!")
 
 async def api_santa_mark_received_logic(bot, pool, uid, gid):
     async with pool.acquire() as conn:
         s = await conn.fetchrow("SELECT user_id FROM public.santa_participants WHERE game_id=$1 AND target_user_id=$2", gid, uid)
-        if s:
-            try: await bot.send_message(s['user_id'], "🎉 Подарок получен!")
-            except: pass
+    if s:
+        await bot.notifier.enqueue(s['user_id'], "🎉 Подарок получен!")
+
+# --- МОНИТОРИНГ ---
+def metrics_authorized(request):
+    return request.headers.get('Authorization') == f"Bearer {METRICS_TOKEN}"
+
+async def api_stats(request):
+    # Не для Mini App: без CORS и только с METRICS_TOKEN
+    if not METRICS_TOKEN: raise web.HTTPNotFound()
+    if not metrics_authorized(request): raise web.HTTPUnauthorized()
+    return web.json_response({"status": "ok", "name_cache": name_cache.stats(), "collection_cache": collection_cache.stats(), "invoice_cache": invoice_cache.stats(), "notifications": bot.notifier.stats(), "contributions": bot.contributions.stats(), "group_activity": bot.activity.stats(), "maintenance": bot.maintenance.stats(), "santa_jobs": bot.santa_jobs.stats(), "collection_push": bot.hub.stats(), "db": bot.db_pool.stats()})
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else 'unmatched'
+    phases = {}
+    token = request_phases.set(phases)
+    status, t0 = 500, time.perf_counter()
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        request_phases.reset(token)
+        labels = (('method', request.method), ('route', route))
+        metrics.inc('giftflow_http_requests_total', labels + (('status', str(status)),))
+        # Длительность SSE — это время просмотра, а не задержка: в гистограмму и лог медленных не пишем
+        if not request.get('streaming'): metrics.observe('giftflow_http_request_duration_seconds', labels, elapsed)
+        if SLOW_REQUEST_MS and not request.get('streaming') and elapsed * 1000 >= SLOW_REQUEST_MS:
+            # Фазы суммируются по всем вызовам, включая параллельные, поэтому их сумма может превышать общее время
+            parts = [f"{name} {t * 1000:.0f} ms ×{n}" for name, (n, t) in sorted(phases.items())]
+            parts.append(f"other {max(0.0, elapsed - sum(t for _, t in phases.values())) * 1000:.0f} ms")
+            logging.warning(f"🐢 Slow request {request.method} {route} -> {status} in {elapsed * 1000:.0f} ms: {', '.join(parts)}")
+
+async def api_metrics(request):
+    if not METRICS_TOKEN: raise web.HTTPNotFound()
+    if not metrics_authorized(request): raise web.HTTPUnauthorized()
+    db, notify, contrib = bot.db_pool.stats(), bot.notifier.stats(), bot.contributions.stats()
+    extra = [("giftflow_db_pool_connections", 'gauge', (('state', s),), db[s]) for s in ('size', 'idle', 'in_use', 'max_size')]
+    extra += [("giftflow_db_pool_waiting", 'gauge', (), db['waiting']), ("giftflow_db_pool_acquire_timeouts_total", 'counter', (), db['acquire_timeouts'])]
+    queries = sorted(db_stats.queries.items())
+    extra += [("giftflow_db_queries_total", 'counter', (('query', q),), c) for q, (c, _, _) in queries]
+    extra += [("giftflow_db_query_seconds_total", 'counter', (('query', q),), round(t, 6)) for q, (_, t, _) in queries]
+    extra += [("giftflow_notifications_queued", 'gauge', (('where', 'queue'),), notify['queued']), ("giftflow_notifications_queued", 'gauge', (('where', 'in_memory'),), notify['in_memory'])]
+    try:
+        async with bot.db_pool.acquire() as conn:
+            backlog = await conn.fetchrow("SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE next_attempt_at <= NOW()) AS due FROM public.notification_outbox")
+        extra += [("giftflow_notification_outbox_rows", 'gauge', (('state', 'total'),), backlog['total']), ("giftflow_notification_outbox_rows", 'gauge', (('state', 'due'),), backlog['due'])]
+        async with bot.db_pool.acquire() as conn:
+            payments = await conn.fetchrow("SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE attempts > 0) AS failing FROM public.pending_payments")
+        extra += [("giftflow_pending_payments_rows", 'gauge', (('state', k),), payments[k]) for k in ('total', 'failing')]
+    except Exception as e: logging.warning(f"Metrics: outbox/payments backlog unavailable: {e}")
+    extra += [("giftflow_notifications_total", 'counter', (('outcome', k),), notify[k]) for k in ('sent', 'failed', 'retried')]
+    extra += [("giftflow_contributions_pending", 'gauge', (('state', k),), contrib[k]) for k in ('pending', 'inflight')]
+    extra += [("giftflow_contributions_total", 'counter', (('outcome', k),), contrib[k]) for k in ('ingested', 'duplicates', 'parked', 'recovered')]
+    extra += [("giftflow_contribution_batches_total", 'counter', (), contrib['batches']), ("giftflow_contribution_retries_total", 'counter', (), contrib['retries'])]
+    activity = bot.activity.stats()
+    extra += [("giftflow_group_activity_pending", 'gauge', (('kind', k),), activity[f'pending_{k}']) for k in ('chats', 'members')]
+    extra += [("giftflow_group_activity_touches_total", 'counter', (), activity['touches'])]
+    extra += [("giftflow_group_activity_writes_total", 'counter', (('kind', k),), activity[f'{k}_writes']) for k in ('chat', 'member')]
+    hub = bot.hub.stats()
+    extra += [("giftflow_sse_clients", 'gauge', (), hub['clients']), ("giftflow_sse_collections", 'gauge', (), hub['collections'])]
+    extra += [("giftflow_collection_push_events_total", 'counter', (('kind', k),), hub[k]) for k in ('published', 'remote', 'delivered', 'superseded')]
+    santa_jobs = bot.santa_jobs.stats()
+    extra += [("giftflow_santa_jobs_running", 'gauge', (), santa_jobs['running'])]
+    extra += [("giftflow_santa_jobs_total", 'counter', (('outcome', k),), santa_jobs[k]) for k in ('submitted', 'drawn', 'failed', 'resumed')]
+    extra += [("giftflow_maintenance_rows_total", 'counter', (('task', k),), v) for k, v in sorted(bot.maintenance.removed.items())]
+    caches = (('name', name_cache), ('collection', collection_cache), ('invoice', invoice_cache), ('upload', upload_cache), ('webapp_auth', webapp_auth_cache))
+    extra += [("giftflow_cache_entries", 'gauge', (('cache', n),), len(c._data)) for n, c in caches]
+    extra += [("giftflow_cache_lookups_total", 'counter', (('cache', n), ('result', r)), getattr(c, r)) for n, c in caches for r in ('hits', 'misses', 'coalesced', 'errors')]
+    return web.Response(body=metrics.render(extra).encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
 # --- ЗАГРУЗКА (IMGBB) ---
+def shrink_image(data):
+    # Уменьшаем до UPLOAD_MAX_DIMENSION по большей стороне; если не вышло меньше — отдаём оригинал
+    if Image is None or UPLOAD_MAX_DIMENSION <= 0: return data
+    try:
+        img = Image.open(io.BytesIO(data))
+        if max(img.size) <= UPLOAD_MAX_DIMENSION: return data
+        img.thumbnail((UPLOAD_MAX_DIMENSION, UPLOAD_MAX_DIMENSION))
+        out = io.BytesIO()
+        if img.mode in ('RGBA', 'LA', 'P'): img.save(out, format='PNG', optimize=True)
+        else: img.convert('RGB').save(out, format='JPEG', quality=UPLOAD_JPEG_QUALITY, optimize=True)
+        return out.getvalue() if out.tell() < len(data) else data
+    except Exception as e:
+        logging.warning(f"Image shrink skipped: {e}")
+        return data
+
+async def upload_image(pool, session, data, digest):
+    # Одинаковые картинки (по sha256) грузим в imgbb один раз: сначала кэш процесса, потом таблица uploaded_images
+    async def load():
+        async with pool.acquire() as conn:
+            url = await conn.fetchval("SELECT url FROM public.uploaded_images WHERE sha256 = $1", digest)
+        if url: return url
+        payload = await asyncio.get_running_loop().run_in_executor(None, shrink_image, data)
+        form = aiohttp.FormData()
+        form.add_field('key', IMGBB_KEY)
+        form.add_field('image', payload, filename='image')
+        async with session.post(IMGBB_UPLOAD_URL, data=form) as resp:
+            res = await resp.json(content_type=None)
+        if not res.get('success'): raise RuntimeError("Upload failed")
+        url = res['data']['url']
+        async with pool.acquire() as conn:
+            await conn.execute("INSERT INTO public.uploaded_images (sha256, url) VALUES ($1, $2) ON CONFLICT (sha256) DO NOTHING", digest, url)
+        return url
+    return await upload_cache.get_or_load(digest, load)
+
 @api_handler_wrapper
 async def handle_upload(request):
-    # 👇👇👇 ВСТАВЬ СВОЙ КЛЮЧ 👇👇👇
-    IMGBB_KEY = "7c11778e00b562e2dfd3a7ec7efe0d3e"
-    # 👆👆👆👆👆👆👆👆👆👆👆👆👆
-    
+    too_large = web.json_response({"error": "File too large"}, status=413, headers=CORS_HEADERS)
+    if request.content_length and request.content_length > UPLOAD_MAX_BYTES + UPLOAD_CHUNK_SIZE: return too_large
     reader = await request.multipart()
     field = await reader.next()
-    if field.name == 'image':
-        data = await field.read()
-        async with aiohttp.ClientSession() as sess:
-            form = aiohttp.FormData()
-            form.add_field('key', IMGBB_KEY)
-            form.add_field('image', data)
-            async with sess.post('https://api.imgbb.com/1/upload', data=form) as resp:
-                res = await resp.json()
-                if res.get('success'): return web.json_response({"status": "ok", "url": res['data']['url']}, headers=CORS_HEADERS)
+    if field is not None and field.name == 'image':
+        digest = hashlib.sha256(); data = bytearray()
+        while chunk := await field.read_chunk(UPLOAD_CHUNK_SIZE):
+            data += chunk; digest.update(chunk)
+            if len(data) > UPLOAD_MAX_BYTES: return too_large
+        if data:
+            url = await upload_image(bot.db_pool, bot.http_session, bytes(data), digest.hexdigest())
+            return web.json_response({"status": "ok", "url": url}, headers=CORS_HEADERS)
     return web.json_response({"error": "Upload failed"}, status=500, headers=CORS_HEADERS)
 
-async def serve_index(request): return web.FileResponse(os.path.join(BASE_DIR, 'index.html'), headers=CORS_HEADERS)
-async def serve_script(request): return web.FileResponse(os.path.join(BASE_DIR, 'script.js'), headers=CORS_HEADERS)
-async def serve_style(request): return web.FileResponse(os.path.join(BASE_DIR, 'style.css'), headers=CORS_HEADERS)
+# --- СТАТИКА MINI APP ---
+# На старте читаем файлы, считаем sha256, готовим gzip/brotli. script.js и style.css раздаются по
+# адресам с хэшем (/static/script.<hash>.js) как immutable, index.html — с ETag, повторное открытие = 304.
+STATIC_FILES = ('script.js', 'style.css')
+STATIC_ASSETS = {}
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+def make_asset(name, body):
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    variants = {'gzip': gzip.compress(body, 9, mtime=0)}
+    if brotli: variants['br'] = brotli.compress(body, quality=11)
+    variants = {enc: data for enc, data in variants.items() if len(data) < len(body)}
+    base, ext = os.path.splitext(name)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    return {"name": name, "body": body, "variants": variants, "etag": f'W/"{digest}"', "content_type": content_type, "fingerprinted": f"{base}.{digest}{ext}"}
+
+def build_static_assets():
+    assets = {}
+    for name in STATIC_FILES:
+        with open(os.path.join(BASE_DIR, name), 'rb') as f: assets[name] = make_asset(name, f.read())
+    with open(os.path.join(BASE_DIR, 'index.html'), encoding='utf-8') as f: index = f.read()
+    for name in STATIC_FILES:
+        index = re.sub(rf'(src|href)="/?{re.escape(name)}(\?[^"]*)?"', rf'\1="/static/{assets[name]["fingerprinted"]}"', index)
+    assets['index.html'] = make_asset('index.html', index.encode('utf-8'))
+    for name in STATIC_FILES: assets[assets[name]['fingerprinted']] = assets[name]
+    return assets
+
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        enc, _, params = part.strip().partition(';')
+        if enc and params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'): accepted.add(enc.lower())
+    return accepted
+
+def asset_response(request, asset, cache_control):
+    headers = {**CORS_HEADERS, "ETag": asset['etag'], "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if asset['etag'] in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+        return web.Response(status=304, headers=headers)
+    accepted = accepted_encodings(request)
+    body = asset['body']
+    for enc in ('br', 'gzip'):
+        if enc in asset['variants'] and enc in accepted:
+            body = asset['variants'][enc]; headers["Content-Encoding"] = enc
+            break
+    return web.Response(body=body, content_type=asset['content_type'], charset='utf-8', headers=headers)
+
+async def serve_index(request): return asset_response(request, STATIC_ASSETS['index.html'], REVALIDATE_CACHE)
+async def serve_script(request): return asset_response(request, STATIC_ASSETS['script.js'], REVALIDATE_CACHE)
+async def serve_style(request): return asset_response(request, STATIC_ASSETS['style.css'], REVALIDATE_CACHE)
+
+async def serve_static(request):
+    asset = STATIC_ASSETS.get(request.match_info['name'])
+    if not asset or asset['fingerprinted'] != request.match_info['name']: raise web.HTTPNotFound()
+    return asset_response(request, asset, IMMUTABLE_CACHE)
 
 # --- ЗАПУСК ---
 async def on_startup(app):
@@ -429,17 +2073,44 @@ async def on_startup(app):
     bot.db_pool = await create_db_pool()
     bot_info = await bot.get_me()
     bot.username = bot_info.username
+    bot.http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, ttl_dns_cache=300), timeout=aiohttp.ClientTimeout(total=60))
+    bot.notifier = NotificationQueue(bot, bot.db_pool)
+    bot.notifier.start()
+    bot.hub = CollectionHub(bot.db_pool)
+    await bot.hub.start()
+    bot.contributions = ContributionIngestor(bot.db_pool, bot.notifier, bot.hub)
+    bot.contributions.start()
+    bot.activity = ActivityTracker(bot.db_pool)
+    bot.activity.start()
+    bot.maintenance = Maintenance(bot, bot.db_pool)
+    bot.maintenance.start()
+    bot.santa_jobs = SantaJobs(bot, bot.db_pool)
+    bot.santa_jobs.start()
     logging.info(f"🤖 Bot started: @{bot.username}")
-    asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+    if BOT_MODE == 'webhook':
+        # set_webhook идемпотентен: каждая реплика при старте выставляет один и тот же адрес
+        await bot.set_webhook(f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types())
+        logging.info(f"🪝 Webhook mode: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+    else:
+        await bot.delete_webhook()
+        asyncio.create_task(dp.start_polling(bot, handle_signals=False, allowed_updates=dp.resolve_used_update_types()))
     logging.info(f"🚀 Web Server started on port {WEB_SERVER_PORT}")
 
 async def on_shutdown(app):
     if bot:
+        await bot.hub.close()
+        await bot.contributions.drain()
+        await bot.maintenance.stop()
+        await bot.santa_jobs.stop()
+        await bot.activity.stop()
+        await bot.notifier.stop()
+        await bot.http_session.close()
         await bot.db_pool.close()
         await bot.session.close()
 
 def main():
-    app = web.Application()
+    STATIC_ASSETS.update(build_static_assets())
+    app = web.Application(middlewares=[metrics_middleware, api_guard])
     app.router.add_route('OPTIONS', '/api/{tail:.*}', handle_options)
     app.router.add_post('/api/chats', api_get_chats)
     app.router.add_post('/api/collections/my', api_get_my_collections)
@@ -448,18 +2119,28 @@ def main():
     app.router.add_post('/api/collections/create', api_create_collection)
     app.router.add_post('/api/collections/delete', api_delete_collection)
     app.router.add_post('/api/collections/invoice', api_create_invoice)
+    app.router.add_post('/api/collections/stream_token', api_collection_stream_token)
+    app.router.add_get('/api/collections/stream', api_collection_stream)
     # САНТА РОУТЫ
     app.router.add_post('/api/santa/state', api_santa_get_state)
     app.router.add_post('/api/santa/create', api_santa_create)
     app.router.add_post('/api/santa/join', api_santa_join)
     app.router.add_post('/api/santa/start', api_santa_start)
+    app.router.add_post('/api/santa/job', api_santa_job)
+    app.router.add_post('/api/santa/exclude', api_santa_exclude)
     app.router.add_post('/api/santa/sent', api_santa_mark_sent)
     app.router.add_post('/api/santa/received', api_santa_mark_received)
     
     app.router.add_post('/api/upload', handle_upload)
+    app.router.add_get('/api/stats', api_stats)
+    app.router.add_get('/metrics', api_metrics)
     app.router.add_get('/', serve_index)
     app.router.add_get('/script.js', serve_script)
     app.router.add_get('/style.css', serve_style)
+    app.router.add_get('/static/{name}', serve_static)
+    if BOT_MODE == 'webhook':
+        # Отвечаем Telegram только после обработки: упавший апдейт (например, платёж, не записанный в БД) вернётся повтором
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=False).register(app, path=WEBHOOK_PATH)
     
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
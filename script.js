@@ -1,7 +1,5 @@
 const webApp = window.Telegram.WebApp;
 const API_BASE = window.location.origin + "/api";
-// Обновляем версию, чтобы сбросить старый багованный скрипт
-const APP_VERSION = '?v=FIXED_NAMES_V1';
 
 console.log("🚀 App started. API Base:", API_BASE);
 
@@ -15,7 +13,11 @@ let loadedChats = [];
 let currentCollectionId = null;
 let isCreator = false;
 let santaInviteLink = null;
+let collectionStream = null;
+let collectionsChanged = false;
 const DEFAULT_IMAGE = "https://cdn-icons-png.flaticon.com/512/9466/9466245.png";
+// На 429 с коротким Retry-After молча ждём и повторяем один раз, вместо алерта
+const RATE_LIMIT_RETRY_MAX_S = 5;
 
 // --- API ---
 async function fetchAPI(endpoint, data = {}, showLoader = true) {
@@ -25,12 +27,22 @@ async function fetchAPI(endpoint, data = {}, showLoader = true) {
 
     // console.log(`📡 ${endpoint}`, data);
 
+    // Сервер берёт пользователя из подписанного initData, chat_id остаётся для локальной отладки
+    const post = () => fetch(API_BASE + endpoint, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', 'X-Telegram-Init-Data': webApp.initData || '' },
+        body: JSON.stringify({ chat_id: effectiveUserId, ...data })
+    });
+
     try {
-        const response = await fetch(API_BASE + endpoint + APP_VERSION, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ chat_id: effectiveUserId, ...data })
-        });
+        let response = await post();
+        if (response.status === 429) {
+            const wait = parseInt(response.headers.get('Retry-After'), 10) || 1;
+            if (wait > RATE_LIMIT_RETRY_MAX_S) throw new Error(`Слишком много запросов, попробуйте через ${wait} с`);
+            await new Promise(resolve => setTimeout(resolve, wait * 1000));
+            response = await post();
+            if (response.status === 429) throw new Error("Слишком много запросов, попробуйте чуть позже");
+        }
 
         const text = await response.text();
         if (!response.ok) {
@@ -98,11 +110,18 @@ function loadQuickCollectData() {
     });
 }
 
-// Загрузка для вкладки "Мои сборы"
+// Загрузка для вкладки "Мои сборы" (первая страница каждого списка)
 function loadMyCollectionsData() {
     fetchAPI('/collections/my').then(data => {
-        renderCollections(data.data.created, 'list-created');
-        renderCollections(data.data.participated, 'list-participated');
+        renderCollections(data.data.created, 'list-created', data.data.created_cursor, 'created');
+        renderCollections(data.data.participated, 'list-participated', data.data.participated_cursor, 'participated');
+    });
+}
+
+// Следующая страница одного списка по курсору
+window.loadMoreCollections = function(section, cursor) {
+    fetchAPI('/collections/my', { list: section, cursor: cursor }).then(data => {
+        renderCollections(data.data[section], `list-${section}`, data.data[`${section}_cursor`], section, true);
     });
 }
 
@@ -117,11 +136,13 @@ function renderChatSelect() {
     }
 }
 
-function renderCollections(list, containerId) {
+function renderCollections(list, containerId, cursor = null, section = null, append = false) {
     const container = document.getElementById(containerId);
     if (!container) return;
-    container.innerHTML = '';
-    if (!list || list.length === 0) {
+    const moreBtn = container.querySelector('.load-more');
+    if (moreBtn) moreBtn.remove();
+    if (!append) container.innerHTML = '';
+    if (!append && (!list || list.length === 0)) {
         container.innerHTML = '<p class="text-center" style="color: gray;">Пока пусто</p>';
         return;
     }
@@ -133,6 +154,7 @@ function renderCollections(list, containerId) {
                 <div style="font-size: 12px; color: #aaa; display: flex; justify-content: space-between;"><span>${c.amount.toLocaleString()} ₽</span><span>${c.percent}%</span></div>
             </div>`;
     });
+    if (cursor) container.innerHTML += `<button class="collect-btn load-more" onclick="loadMoreCollections('${section}', '${cursor}')" style="background: #444;">Показать ещё</button>`;
 }
 
 // --- ДЕЙСТВИЯ СБОРОВ ---
@@ -215,7 +237,21 @@ function showSantaGame(state) {
 // --- ДЕЙСТВИЯ САНТЫ ---
 window.createSantaGame = function() { fetchAPI('/santa/create', { title: "Тайный Санта" }).then(initSanta); }
 window.saveSantaWishlist = function() { const w = document.getElementById('santa-wishlist').value; if(!w) return webApp.showAlert("Пусто!"); fetchAPI('/santa/join', { game_id: santaGameId, wishlist: w }).then(() => { webApp.showAlert("Сохранено!"); initSanta(); }); }
-window.startSantaGame = function() { webApp.showConfirm("Начать жеребьевку?", (ok) => { if(ok && santaGameId) fetchAPI('/santa/start', { game_id: santaGameId }).then(initSanta); }); }
+window.startSantaGame = function() { webApp.showConfirm("Начать жеребьевку?", (ok) => { if(ok && santaGameId) fetchAPI('/santa/start', { game_id: santaGameId }).then(res => pollSantaJob(res.job_id)); }); }
+
+// Жеребьевка идёт в фоне: опрашиваем задание, пока идёт розыгрыш, потом показываем, сколько уведомлений разослано
+function pollSantaJob(jobId, drawn = false) {
+    const progress = document.getElementById('santa-job-progress');
+    fetchAPI('/santa/job', { job_id: jobId }, false).then(res => {
+        const job = res.job;
+        if (job.state === 'failed') { progress.style.display = 'none'; return webApp.showAlert(`Жеребьевка не удалась:\n${job.error || ''}`); }
+        if (job.state === 'queued' || job.state === 'drawing') return setTimeout(() => pollSantaJob(jobId), 1500);
+        if (!drawn) initSanta();
+        progress.style.display = 'block';
+        progress.textContent = `📨 Уведомления: ${job.sent} из ${job.total}` + (job.failed ? `, не доставлено: ${job.failed}` : '');
+        if (job.state === 'notifying') setTimeout(() => pollSantaJob(jobId, true), 3000);
+    }).catch(() => { progress.style.display = 'none'; });
+}
 window.shareSantaLink = function() { 
     if(santaInviteLink) webApp.openTelegramLink(`https://t.me/share/url?url=${encodeURIComponent(santaInviteLink)}&text=Го в Санту!`); 
     else webApp.showAlert("Ссылка не найдена");
@@ -236,29 +272,75 @@ window.openCollectionDetails = function(id) {
     fetchAPI('/collections/info', { collection_id: currentCollectionId }).then(data => {
         const item = data.data;
         document.getElementById('detail-goal').textContent = item.goal; document.getElementById('detail-desc').textContent = item.description || "Нет описания";
-        document.getElementById('detail-current').textContent = `${item.current.toLocaleString()} ₽`; document.getElementById('detail-total').textContent = `из ${item.amount.toLocaleString()} ₽`;
-        document.getElementById('detail-progress').style.width = `${item.percent}%`;
+        renderCollectionProgress(item);
         let img = item.image_url || DEFAULT_IMAGE; if(img !== DEFAULT_IMAGE) img += "?t=" + Date.now();
         document.getElementById('detail-img').src = img; document.getElementById('detail-img-url-hidden').value = item.image_url || DEFAULT_IMAGE;
         
         isCreator = String(item.creator_id) === String(userId);
         document.getElementById('edit-btn-container').style.display = isCreator ? 'block' : 'none';
         
-        if (item.status === 'finished') { document.getElementById('payment-control-block').style.display = 'none'; document.getElementById('finished-message').style.display = 'block'; } else { document.getElementById('payment-control-block').style.display = 'block'; document.getElementById('finished-message').style.display = 'none'; }
+        watchCollection(currentCollectionId);
     });
 }
-window.closeDetails = function() { document.getElementById('collection-details').style.display = 'none'; }
+
+function renderCollectionProgress(p) {
+    document.getElementById('detail-current').textContent = `${p.current.toLocaleString()} ₽`; document.getElementById('detail-total').textContent = `из ${p.amount.toLocaleString()} ₽`;
+    document.getElementById('detail-progress').style.width = `${p.percent}%`;
+    if (p.status === 'finished') { document.getElementById('payment-control-block').style.display = 'none'; document.getElementById('finished-message').style.display = 'block'; } else { document.getElementById('payment-control-block').style.display = 'block'; document.getElementById('finished-message').style.display = 'none'; }
+}
+
+// Прогресс открытого сбора приходит с сервера (SSE) — без повторных запросов /collections/info и /collections/my.
+// initData в адрес EventSource не кладём: поток открывается по короткому токену, выданному на этот сбор
+let watchGeneration = 0;
+async function watchCollection(id) {
+    stopWatchingCollection();
+    if (!window.EventSource) return;
+    const generation = watchGeneration;
+    let token;
+    try {
+        const r = await fetch(`${API_BASE}/collections/stream_token`, { method: 'POST', headers: { 'Content-Type': 'application/json', 'X-Telegram-Init-Data': webApp.initData || '' }, body: JSON.stringify({ chat_id: webApp.initDataUnsafe?.user?.id || 12345, collection_id: id }) });
+        token = (await r.json()).token;
+    } catch (e) { token = null; }
+    if (generation !== watchGeneration) return;
+    if (!token) { setTimeout(() => { if (generation === watchGeneration) watchCollection(id); }, 5000); return; }
+    const params = new URLSearchParams({ collection_id: id, token });
+    const stream = collectionStream = new EventSource(`${API_BASE}/collections/stream?${params}`);
+    let shown = null;
+    stream.addEventListener('progress', (e) => {
+        const p = JSON.parse(e.data);
+        if (String(p.id) !== currentCollectionId) return;
+        if (shown !== null && shown !== p.current) collectionsChanged = true;
+        shown = p.current;
+        renderCollectionProgress(p);
+    });
+    // Токен живёт минуту: если браузер сдался с переподключением (401 на старый токен), берём новый
+    stream.addEventListener('error', () => {
+        if (stream.readyState === EventSource.CLOSED && collectionStream === stream) setTimeout(() => { if (collectionStream === stream) watchCollection(id); }, 5000);
+    });
+}
+
+function stopWatchingCollection() {
+    watchGeneration++;
+    if (collectionStream) { collectionStream.close(); collectionStream = null; }
+}
+
+window.closeDetails = function() {
+    document.getElementById('collection-details').style.display = 'none';
+    stopWatchingCollection();
+    // Список перечитываем один раз при выходе из деталей, и только если за это время что-то изменилось
+    if (collectionsChanged) { collectionsChanged = false; loadMyCollectionsData(); }
+}
 window.enableEditMode = function() { if(!isCreator) return; document.getElementById('view-controls').style.display='none'; document.getElementById('edit-controls').style.display='block'; document.getElementById('detail-desc-input').value = document.getElementById('detail-desc').textContent; }
-window.saveChanges = function() { const d = document.getElementById('detail-desc-input').value; const i = document.getElementById('detail-img-url-hidden').value; fetchAPI('/collections/update', { collection_id: currentCollectionId, description: d, image_url: i }).then(() => { webApp.showAlert("Сохранено!"); closeDetails(); loadMyCollectionsData(); }); }
+window.saveChanges = function() { const d = document.getElementById('detail-desc-input').value; const i = document.getElementById('detail-img-url-hidden').value; fetchAPI('/collections/update', { collection_id: currentCollectionId, description: d, image_url: i }).then(() => { webApp.showAlert("Сохранено!"); collectionsChanged = true; closeDetails(); }); }
 
 window.deleteCollection = function() {
     webApp.showConfirm("Удалить сбор?", (ok) => {
-        if(ok) fetchAPI('/collections/delete', { collection_id: currentCollectionId }).then(() => { webApp.showAlert("Удалено"); closeDetails(); loadMyCollectionsData(); });
+        if(ok) fetchAPI('/collections/delete', { collection_id: currentCollectionId }).then(() => { webApp.showAlert("Удалено"); collectionsChanged = true; closeDetails(); });
     });
 }
 
-document.addEventListener('DOMContentLoaded', () => { const fi = document.getElementById('image-upload-input'); if(fi) fi.addEventListener('change', () => { const f = fi.files[0]; if(!f) return; const st = document.getElementById('upload-status'); st.textContent = "Загрузка..."; const fd = new FormData(); fd.append('image', f); fetch("/api/upload", { method: 'POST', body: fd }).then(r=>r.json()).then(d=>{ if(d.status==='ok') { document.getElementById('detail-img-url-hidden').value = d.url; st.textContent = "✅ ОК"; } else st.textContent = "Ошибка"; }).catch(()=>st.textContent="Ошибка"); }); });
-window.initiatePayment = function() { const amount = parseInt(document.getElementById('contribute-input').value); if(!amount || amount <= 0) return webApp.showAlert("Некорректная сумма!"); fetchAPI('/collections/invoice', { collection_id: currentCollectionId, amount: amount }).then(d => { if(d.invoice_url) webApp.openInvoice(d.invoice_url, (s) => { if(s==='paid') { webApp.showAlert("Оплачено!"); closeDetails(); setTimeout(loadMyCollectionsData, 1500); } }); else webApp.showAlert("Ошибка инвойса"); }); }
+document.addEventListener('DOMContentLoaded', () => { const fi = document.getElementById('image-upload-input'); if(fi) fi.addEventListener('change', () => { const f = fi.files[0]; if(!f) return; const st = document.getElementById('upload-status'); st.textContent = "Загрузка..."; const fd = new FormData(); fd.append('image', f); fetch("/api/upload", { method: 'POST', body: fd, headers: { 'X-Telegram-Init-Data': webApp.initData || '' } }).then(r=>r.json()).then(d=>{ if(d.status==='ok') { document.getElementById('detail-img-url-hidden').value = d.url; st.textContent = "✅ ОК"; } else st.textContent = "Ошибка"; }).catch(()=>st.textContent="Ошибка"); }); });
+window.initiatePayment = function() { const amount = parseInt(document.getElementById('contribute-input').value); if(!amount || amount <= 0) return webApp.showAlert("Некорректная сумма!"); fetchAPI('/collections/invoice', { collection_id: currentCollectionId, amount: amount }).then(d => { if(d.invoice_url) webApp.openInvoice(d.invoice_url, (s) => { if(s==='paid') { collectionsChanged = true; webApp.showAlert("Оплачено! Прогресс обновится автоматически."); } }); else webApp.showAlert("Ошибка инвойса"); }); }
 
 function renderWishlistText(text) { if (!text) return "Вишлист пуст"; let safeText = text.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;"); const markdownLinkRegex = /\[([^\]]+)\]\(([^)]+)\)/g; safeText = safeText.replace(markdownLinkRegex, (m, txt, url) => `<a href="${url}" target="_blank" class="wishlist-link"><i class="fas fa-external-link-alt"></i> ${txt}</a>`); return safeText.replace(/\n/g, '<br>'); }
 
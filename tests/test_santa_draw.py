@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/test")
+
+from main import santa_draw
+
+
+def assert_valid(ids, result, exclusions=()):
+    assert result is not None
+    assert set(result) == set(ids)
+    assert sorted(result.values()) == sorted(ids)
+    assert all(g != r for g, r in result.items())
+    assert not set(result.items()) & set(exclusions)
+
+
+def test_seeded_draw_is_pinned():
+    # Один и тот же seed — одна и та же жеребьёвка
+    assert santa_draw([1, 2, 3, 4, 5], seed=42) == {1: 4, 4: 2, 2: 3, 3: 5, 5: 1}
+    assert santa_draw([5, 4, 3, 2, 1, 1], seed=42) == santa_draw([1, 2, 3, 4, 5], seed=42)
+
+
+@pytest.mark.parametrize("n", [2, 3, 10, 101])
+def test_derangement(n):
+    ids = list(range(1, n + 1))
+    for seed in range(20):
+        assert_valid(ids, santa_draw(ids, seed=seed))
+
+
+def test_exclusions_respected():
+    ids = list(range(1, 11))
+    exclusions = [(a, a + 1) for a in range(1, 10, 2)] + [(a + 1, a) for a in range(1, 10, 2)]
+    for seed in range(20):
+        assert_valid(ids, santa_draw(ids, exclusions, seed=seed), exclusions)
+
+
+def test_exclusions_force_repair():
+    # Единого цикла нет: допустимы только пары 1<->2 и 3<->4
+    allowed = {(1, 2), (2, 1), (3, 4), (4, 3)}
+    exclusions = [(g, r) for g in range(1, 5) for r in range(1, 5) if g != r and (g, r) not in allowed]
+    assert santa_draw([1, 2, 3, 4], exclusions, seed=0) == {1: 2, 2: 1, 3: 4, 4: 3}
+
+
+@pytest.mark.parametrize("ids, exclusions", [
+    ([], []),
+    ([1], []),
+    ([1, 2], [(1, 2)]),
+    ([1, 2, 3], [(1, 2), (1, 3)]),
+])
+def test_infeasible_returns_none(ids, exclusions):
+    assert santa_draw(ids, exclusions, seed=0) is None